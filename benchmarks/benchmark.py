@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Benchmark github-backup against a local fake GitHub.
+
+Every scenario is backed up twice into a fresh directory: a "cold" run that
+starts from nothing and a "warm" run that finds the previous backup. For each
+run the wall time, API calls, bytes served, peak RSS of the backup process
+and files written are reported, and compared with a saved baseline.
+
+    python benchmarks/benchmark.py --save-baseline baseline.json
+    python benchmarks/benchmark.py --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_github import FakeGitHub, LOGIN
+
+GITHUB_BACKUP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'github_backup', 'github_backup.py')
+
+ISSUE_ARGS = ['--issues', '--issue-comments', '--issue-events',
+              '--pulls', '--pull-comments', '--pull-commits']
+
+SCENARIOS = {
+    'many-repos': {
+        'repos': 200,
+        'args': ['-j', '4'],
+    },
+    'issues': {
+        'repos': 2, 'issues': 20, 'comments': 3, 'events': 2,
+        'args': ISSUE_ARGS,
+    },
+    'issues-bulk': {
+        'repos': 2, 'issues': 20, 'comments': 3, 'events': 2,
+        'args': ISSUE_ARGS + ['--bulk-comments'],
+    },
+    'releases': {
+        'repos': 10, 'releases': 5, 'assets': 4, 'asset_size': 256 * 1024,
+        'args': ['--releases', '--assets'],
+    },
+    'latency': {
+        'repos': 20, 'issues': 4, 'comments': 1, 'latency': 0.05,
+        'args': ['-j', '8', '--issues', '--issue-comments'],
+    },
+}
+
+METRICS = ('wall_time', 'api_calls', 'bytes_sent', 'peak_rss_kb', 'files_written')
+
+def count_files_written(path, since):
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                if os.stat(os.path.join(dirpath, filename)).st_mtime >= since:
+                    count += 1
+            except OSError:
+                pass
+    return count
+
+def run_backup(fake, backupdir, extra_args):
+    """Run one backup in a child process and return its measurements."""
+    cmd = [sys.executable, GITHUB_BACKUP, LOGIN, backupdir, '--api-url', fake.url, '--quiet']
+    cmd += fake.scenario.get('args', []) + extra_args
+    fake.stats.reset()
+    start = time.time()
+    with open(os.path.join(os.path.dirname(backupdir), 'log.txt'), 'a') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=log)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.time() - start
+    result = fake.stats.snapshot()
+    result.update({
+        'exit_code': proc.returncode,
+        'wall_time': round(wall_time, 3),
+        'peak_rss_kb': usage.ru_maxrss,
+        'files_written': count_files_written(backupdir, start),
+    })
+    return result
+
+def run_scenario(name, scenario, extra_args, keep):
+    workdir = tempfile.mkdtemp(prefix='github-backup-bench-%s-' % name)
+    fake = FakeGitHub(scenario, workdir).start()
+    try:
+        backupdir = os.path.join(workdir, 'backup')
+        return {
+            'cold': run_backup(fake, backupdir, extra_args),
+            'warm': run_backup(fake, backupdir, extra_args),
+        }
+    finally:
+        fake.stop()
+        if keep:
+            print("Kept %s" % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+def compare(results, baseline, threshold):
+    """Print every metric against the baseline, and return the regressions beyond threshold."""
+    regressions = []
+    print("%-12s %-5s %-14s %14s %14s %9s" % ('scenario', 'run', 'metric', 'baseline', 'now', 'change'))
+    for name, runs in sorted(results.items()):
+        for run, result in sorted(runs.items()):
+            for metric in METRICS:
+                now = result[metric]
+                before = baseline.get(name, {}).get(run, {}).get(metric)
+                if not before:
+                    print("%-12s %-5s %-14s %14s %14s" % (name, run, metric, '-', now))
+                    continue
+                change = (now - before) / float(before)
+                flag = ''
+                if change > threshold:
+                    regressions.append((name, run, metric, before, now))
+                    flag = ' !'
+                print("%-12s %-5s %-14s %14s %14s %+8.1f%%%s" % (name, run, metric, before, now, change * 100, flag))
+    return regressions
+
+def main():
+    parser = ArgumentParser(description='benchmark github-backup against a local fake GitHub')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='run only this scenario (can be given several times)')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results as the new baseline to FILE')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='report metrics that grew by more than this fraction of the baseline (default: 0.1)')
+    parser.add_argument('--keep', action='store_true', help="don't delete the working directories")
+    parser.add_argument('extra_args', nargs='*', help='extra arguments for github-backup, after --')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenario or sorted(SCENARIOS):
+        print("Running scenario %s..." % name)
+        results[name] = run_scenario(name, SCENARIOS[name], args.extra_args, args.keep)
+        for run in ('cold', 'warm'):
+            if results[name][run]['exit_code']:
+                print("  %s run exited with %d" % (run, results[name][run]['exit_code']))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    failed = any(run['exit_code'] for runs in results.values() for run in runs.values())
+    if regressions:
+        print("%d metrics regressed by more than %d%%" % (len(regressions), args.threshold * 100))
+    return 1 if regressions or failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
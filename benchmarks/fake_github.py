@@ -0,0 +1,379 @@
+"""
+A local stand-in for the parts of the GitHub REST API that github-backup uses.
+
+The account, its repositories, issues, pull requests, comments, releases and
+assets are generated from a scenario dict. The git repositories themselves
+are bare repositories on disk, served as file:// clone URLs.
+"""
+
+import os
+import re
+import json
+import hashlib
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+LOGIN = 'bench'
+EPOCH = 1700000000
+
+def timestamp(offset):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(EPOCH + offset))
+
+def git(*args, cwd=None):
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com',
+               GIT_AUTHOR_DATE=timestamp(0), GIT_COMMITTER_DATE=timestamp(0))
+    subprocess.run(('git',) + args, cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def make_repositories(workdir, count, commits):
+    """Create count bare repositories with commits commits each, and return their paths."""
+    template = os.path.join(workdir, 'template')
+    git('init', '-q', '-b', 'master', template)
+    for i in range(commits):
+        with open(os.path.join(template, 'file-%d.txt' % (i % 10)), 'a') as f:
+            f.write('line %d\n' % i * 20)
+        git('add', '-A', cwd=template)
+        git('commit', '-q', '-m', 'commit %d' % i, cwd=template)
+    paths = []
+    for i in range(count):
+        path = os.path.join(workdir, 'git', 'repo-%04d.git' % i)
+        git('clone', '-q', '--bare', template, path)
+        paths.append(path)
+    return paths
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, dirnames, filenames in os.walk(path) for filename in filenames)
+
+class Account(object):
+    """The synthetic data of one scenario."""
+
+    def __init__(self, scenario, workdir, base_url):
+        self.scenario = scenario
+        self.base_url = base_url
+        self.git_paths = make_repositories(workdir, scenario['repos'], scenario.get('commits', 5))
+        self.asset_data = os.urandom(scenario.get('asset_size', 0))
+        self.repos = [self._repo(i, path) for i, path in enumerate(self.git_paths)]
+        self.by_name = dict((repo['name'], repo) for repo in self.repos)
+
+    def _user(self):
+        return {
+            'login': LOGIN, 'id': 1, 'type': 'User', 'name': 'Bench Mark', 'email': None,
+            'url': '%s/users/%s' % (self.base_url, LOGIN),
+            'html_url': 'https://github.invalid/%s' % LOGIN,
+        }
+
+    def _repo(self, i, path):
+        name = 'repo-%04d' % i
+        url = '%s/repos/%s/%s' % (self.base_url, LOGIN, name)
+        return {
+            'id': 1000 + i, 'name': name, 'full_name': '%s/%s' % (LOGIN, name),
+            'owner': self._user(), 'private': False, 'fork': False,
+            'description': 'Benchmark repository %d' % i,
+            'url': url, 'html_url': 'https://github.invalid/%s/%s' % (LOGIN, name),
+            'clone_url': 'file://' + path, 'git_url': 'file://' + path, 'ssh_url': 'file://' + path,
+            'default_branch': 'master', 'has_wiki': False, 'has_issues': True, 'size': disk_usage(path) // 1024,
+            'open_issues_count': self.scenario.get('issues', 0),
+            'created_at': timestamp(0), 'updated_at': timestamp(i), 'pushed_at': timestamp(i),
+        }
+
+    def issues(self, repo):
+        issues = []
+        for number in range(1, self.scenario.get('issues', 0) + 1):
+            url = '%s/issues/%d' % (repo['url'], number)
+            issue = {
+                'id': repo['id'] * 100000 + number, 'number': number,
+                'title': 'Issue %d of %s' % (number, repo['name']), 'body': 'x' * 200,
+                'state': 'open' if number % 3 else 'closed', 'user': self._user(),
+                'labels': [], 'assignees': [], 'locked': False,
+                'comments': self.scenario.get('comments', 0),
+                'url': url, 'html_url': url.replace(self.base_url, 'https://github.invalid'),
+                'comments_url': url + '/comments', 'events_url': url + '/events',
+                'created_at': timestamp(number), 'updated_at': timestamp(number),
+            }
+            if number % 2 == 0:
+                issue['pull_request'] = {'url': '%s/pulls/%d' % (repo['url'], number)}
+            issues.append(issue)
+        return issues
+
+    def pull(self, repo, issue):
+        pull = dict(issue)
+        pull.pop('pull_request', None)
+        pull['url'] = issue['pull_request']['url']
+        pull['issue_url'] = issue['url']
+        pull['commits'] = self.scenario.get('commits', 5)
+        pull['review_comments'] = self.scenario.get('comments', 0)
+        pull['merged'] = False
+        pull['head'] = pull['base'] = {'ref': 'master', 'sha': '0' * 40, 'label': LOGIN + ':master'}
+        return pull
+
+    def comments(self, repo, issue, key='issue_url'):
+        kind = 'issues' if key == 'issue_url' else 'pulls'
+        return [{
+            'id': issue['id'] * 100 + i, 'body': 'comment %d' % i, 'user': self._user(),
+            key: issue['url'], 'url': '%s/%s/comments/%d' % (repo['url'], kind, issue['id'] * 100 + i),
+            'created_at': issue['updated_at'], 'updated_at': issue['updated_at'],
+        } for i in range(issue['comments'])]
+
+    def events(self, repo, issue):
+        return [{
+            'id': issue['id'] * 100 + i, 'event': 'labeled', 'actor': self._user(),
+            'issue': {'number': issue['number'], 'url': issue['url']},
+            'url': '%s/issues/events/%d' % (repo['url'], issue['id'] * 100 + i),
+            'created_at': issue['updated_at'],
+        } for i in range(self.scenario.get('events', 0))]
+
+    def commits(self, repo):
+        commits = []
+        for i in range(self.scenario.get('commits', 5)):
+            sha = hashlib.sha1(('%s-%d' % (repo['name'], i)).encode()).hexdigest()
+            commits.append({
+                'sha': sha, 'url': '%s/commits/%s' % (repo['url'], sha),
+                'commit': {'message': 'commit %d' % i, 'author': {'name': 'bench', 'date': timestamp(0)}},
+            })
+        return commits
+
+    def releases(self, repo):
+        releases = []
+        for r in range(self.scenario.get('releases', 0)):
+            release_id = repo['id'] * 1000 + r
+            url = '%s/releases/%d' % (repo['url'], release_id)
+            assets = [{
+                'id': release_id * 100 + a, 'name': 'asset-%d.bin' % a,
+                'size': len(self.asset_data), 'content_type': 'application/octet-stream',
+                'url': '%s/releases/assets/%d' % (repo['url'], release_id * 100 + a),
+                'browser_download_url': '%s/download/%s/%d/asset-%d.bin' % (self.base_url, repo['name'], r, a),
+                'created_at': timestamp(r), 'updated_at': timestamp(r),
+            } for a in range(self.scenario.get('assets', 0))]
+            releases.append({
+                'id': release_id, 'tag_name': 'v%d' % r, 'name': 'Release %d' % r,
+                'url': url, 'assets_url': url + '/assets', 'assets': assets, 'author': self._user(),
+                'created_at': timestamp(r), 'published_at': timestamp(r),
+            })
+        return releases
+
+    def route(self, path, query):
+        """Return the JSON document (or bytes, for downloads) at path, or None."""
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['users', LOGIN]:
+            if len(parts) == 2:
+                return self._user()
+            if parts[2] == 'repos':
+                return self.repos
+            return []
+        if parts[0] == 'user':
+            return self._user() if len(parts) == 1 else []
+        if parts[0] == 'download':
+            return self.asset_data
+        if parts[:2] != ['repos', LOGIN] or len(parts) < 3 or parts[2] not in self.by_name:
+            return None
+
+        repo, rest = self.by_name[parts[2]], parts[3:]
+        if not rest:
+            return repo
+        issues = self.issues(repo)
+        if rest == ['issues', 'events']:
+            # Like GitHub: no since parameter, newest first
+            events = [e for issue in issues if 'pull_request' not in issue for e in self.events(repo, issue)]
+            return sorted(events, key=lambda e: (e['created_at'], e['id']), reverse=True)
+        since = query.get('since')
+        if since:
+            issues = [issue for issue in issues if issue['updated_at'] >= since]
+        pulls = [self.pull(repo, issue) for issue in issues if 'pull_request' in issue]
+        if rest == ['issues']:
+            state = query.get('state', 'open')
+            return [issue for issue in issues if state == 'all' or issue['state'] == state]
+        if rest == ['issues', 'comments']:
+            return [c for issue in issues if 'pull_request' not in issue for c in self.comments(repo, issue)]
+        if rest == ['pulls']:
+            state = query.get('state', 'open')
+            pulls = [pull for pull in pulls if state == 'all' or pull['state'] == state]
+            if query.get('direction') == 'desc':
+                pulls.reverse()
+            return pulls
+        if rest == ['pulls', 'comments']:
+            return [c for pull in pulls for c in self.comments(repo, pull, 'pull_request_url')]
+        if len(rest) == 3 and rest[1] in ('comments', 'events'):
+            # A single comment or event, as fetched to complete a listed one
+            if rest[1] == 'events':
+                items = [e for issue in issues for e in self.events(repo, issue)]
+            elif rest[0] == 'issues':
+                items = [c for issue in issues for c in self.comments(repo, issue)]
+            else:
+                items = [c for pull in pulls for c in self.comments(repo, pull, 'pull_request_url')]
+            matches = [item for item in items if str(item['id']) == rest[2]]
+            return matches[0] if matches else None
+        if rest[0] in ('issues', 'pulls') and len(rest) >= 2 and rest[1].isdigit():
+            number = int(rest[1])
+            matches = [issue for issue in self.issues(repo) if issue['number'] == number]
+            if not matches:
+                return None
+            issue = matches[0]
+            if rest[0] == 'pulls':
+                issue = self.pull(repo, issue)
+            if len(rest) == 2:
+                return issue
+            if rest[2] == 'comments':
+                return self.comments(repo, issue)
+            if rest[2] == 'events':
+                return self.events(repo, issue)
+            if rest[2] == 'commits':
+                return self.commits(repo)
+            return None
+        if rest[0] == 'commits' and len(rest) == 2:
+            matches = [commit for commit in self.commits(repo) if commit['sha'] == rest[1]]
+            return matches[0] if matches else None
+        if rest == ['releases']:
+            return self.releases(repo)
+        if rest[0] == 'releases' and len(rest) in (2, 3):
+            for release in self.releases(repo):
+                if str(release['id']) == rest[1]:
+                    return release if len(rest) == 2 else release['assets']
+            return None
+        return []
+
+class Stats(object):
+    """Counters of the requests served, updated by the handler threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.api_calls = 0
+            self.not_modified = 0
+            self.downloads = 0
+            self.bytes_sent = 0
+            self.endpoints = {}
+
+    def count(self, path, status, size, download):
+        endpoint = re.sub(r'/(\d+|[0-9a-f]{40})(?=/|$)', '/:id', re.sub(r'/repo-\d+', '/:repo', path))
+        with self.lock:
+            if download:
+                self.downloads += 1
+            else:
+                self.api_calls += 1
+                self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+            if status == 304:
+                self.not_modified += 1
+            self.bytes_sent += size
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'api_calls': self.api_calls,
+                'not_modified': self.not_modified,
+                'downloads': self.downloads,
+                'bytes_sent': self.bytes_sent,
+                'endpoints': dict(self.endpoints),
+            }
+
+class FakeGitHub(object):
+    """Serve the Account of a scenario on a free local port.
+
+    Every response carries X-RateLimit-* headers counting down from the
+    scenario's rate_limit, and is delayed by its latency (in seconds). Lists
+    are paginated with Link headers and answer If-None-Match with a 304.
+    """
+
+    def __init__(self, scenario, workdir):
+        self.scenario = scenario
+        self.stats = Stats()
+        self.remaining = scenario.get('rate_limit', 5000)
+        self.reset_at = int(time.time()) + 3600
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.account = Account(scenario, workdir, self.url)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _rate_limit_headers(self):
+        with self.lock:
+            if time.time() > self.reset_at:
+                self.remaining = self.scenario.get('rate_limit', 5000)
+                self.reset_at = int(time.time()) + 3600
+            self.remaining = max(self.remaining - 1, 0)
+            return {
+                'X-RateLimit-Limit': str(self.scenario.get('rate_limit', 5000)),
+                'X-RateLimit-Remaining': str(self.remaining),
+                'X-RateLimit-Reset': str(self.reset_at),
+                'X-RateLimit-Resource': 'core',
+            }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send headers and body together, instead of waiting out Nagle's
+            # algorithm on every response
+            wbufsize = 64 * 1024
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(fake.scenario.get('latency', 0))
+                url = urlsplit(self.path)
+                query = dict(parse_qsl(url.query))
+                data = fake.account.route(url.path, query)
+                download = isinstance(data, bytes)
+                headers = {} if download else fake._rate_limit_headers()
+                if data is None:
+                    return self._send(404, headers, {'message': 'Not Found'}, url.path, download)
+                if download:
+                    return self._send_bytes(data, url.path)
+                if isinstance(data, list):
+                    per_page = int(query.get('per_page', 30))
+                    page = int(query.get('page', 1))
+                    if page * per_page < len(data):
+                        links = []
+                        for rel, number in (('next', page + 1), ('last', (len(data) - 1) // per_page + 1)):
+                            query['page'] = str(number)
+                            links.append('<%s%s?%s>; rel="%s"' % (fake.url, url.path, urlencode(query), rel))
+                        headers['Link'] = ', '.join(links)
+                    data = data[(page - 1) * per_page:page * per_page]
+                self._send(200, headers, data, url.path, download)
+
+            def _send(self, status, headers, data, path, download):
+                body = json.dumps(data).encode('utf-8')
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    status, body = 304, b''
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                fake.stats.count(path, status, len(body), download)
+
+            def _send_bytes(self, data, path):
+                start = 0
+                match = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+                if match:
+                    start = int(match.group(1))
+                self.send_response(206 if start else 200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(data) - start))
+                self.end_headers()
+                self.wfile.write(data[start:])
+                fake.stats.count(path, 200, len(data) - start, True)
+
+        return Handler
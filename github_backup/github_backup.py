@@ -10,20 +10,42 @@ Created: Fri Jun 15 2012
 
 
 import os
+import re
 import errno
+import glob
+import io
+import hashlib
+import shutil
+import math
 import codecs
 import json
 import itertools
 import subprocess
+import sqlite3
 import logging
 import getpass
-from datetime import datetime, timezone
+import sys
+import threading
+import heapq
+import signal
+import socket
+import socketserver
+import contextlib
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import time
 try: #PY3
     from configparser import SafeConfigParser as ConfigParser
 except ImportError:
     from ConfigParser import SafeConfigParser as ConfigParser
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from urllib.parse import urlsplit
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import requests
 import github
@@ -32,10 +54,20 @@ from github import RateLimitExceededException
 LOGGER = logging.getLogger('github-backup')
 
 IS_AUTHORIZED = False
+GRAPHQL = None
 CONFFILE = os.path.join(os.getenv('HOME'), '.github-backup.conf')
 
+# Concurrency limits for git network I/O and GitHub API calls, sized in main()
+GIT_SLOTS = threading.BoundedSemaphore(1)
+API_SLOTS = threading.BoundedSemaphore(1)
+GIT_NETWORK_COMMANDS = ('clone', 'fetch', 'pull', 'ls-remote')
+
+class GitError(Exception):
+    pass
+
 def main():
-    global IS_AUTHORIZED
+    global IS_AUTHORIZED, GIT_SLOTS, API_SLOTS, GRAPHQL, DOWNLOAD_LIMITER, HTTP_CACHE, STORE, MAINTENANCE_BUDGET
+    global ASSET_STORE, WATCHDOG
     logging.basicConfig(level=logging.INFO)
 
 
@@ -72,9 +104,45 @@ def main():
         args.account = True
 
     args.backupdir = args.backupdir.rstrip("/")
+    if args.daemon_socket is None:
+        args.daemon_socket = os.path.join(args.backupdir, 'daemon.sock')
+
+    if args.metadata_store == 'jsonl' and zstandard is None:
+        parser.error("--metadata-store jsonl needs the zstandard package")
+    if args.export_metadata and args.metadata_store == 'files':
+        parser.error("--export-metadata needs --metadata-store jsonl or sqlite")
+    if args.export_metadata:
+        store = METADATA_STORES[args.metadata_store](args.backupdir)
+        export_metadata(store, args.export_metadata)
+        store.close()
+        return 0
+    if args.gc_assets:
+        store = METADATA_STORES[args.metadata_store](args.backupdir)
+        AssetStore(args.backupdir).gc(store, args.backupdir)
+        store.close()
+        return 0
+
+    GIT_SLOTS = threading.BoundedSemaphore(args.git_jobs or args.jobs)
+    API_SLOTS = threading.BoundedSemaphore(args.api_jobs or args.jobs)
+    DOWNLOAD_LIMITER = BandwidthLimiter(args.max_download_rate)
+    WATCHDOG = Watchdog(args.git_timeout, args.http_timeout or None, args.min_transfer_rate,
+                        args.stall_window, args.timeout_retries)
+    MAINTENANCE_BUDGET = MaintenanceBudget(args.maintenance_budget)
+    pool_size = max(args.api_jobs or args.jobs, args.jobs * args.asset_jobs, 10)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    SESSION.mount('https://', adapter)
+    SESSION.mount('http://', adapter)
+    SESSION.hooks['response'].append(count_response)
+    # PyGithub logs every request it makes, which is where they are counted
+    request_logger = logging.getLogger('github-backup.requests')
+    request_logger.setLevel(logging.DEBUG)
+    request_logger.propagate = args.debug
+    request_logger.addHandler(RequestCounter())
+    github.Requester.Requester.injectLogger(request_logger)
 
     # Make the connection to Github here.
     config = {}
+    extra_tokens = []
     if args.password == False:
         # no password option given, continue unauthenticated
         # unauthenticated users can only use http git method
@@ -89,6 +157,9 @@ def main():
                 config['password'] = cfg.get('github-backup', 'APITOKEN')
             except:
                 config['password'] = cfg.get('github-backup', 'PASSWORD')
+            if cfg.has_option('github-backup', 'APITOKENS'):
+                tokens = cfg.get('github-backup', 'APITOKENS')
+                extra_tokens = [t for t in re.split(r'[\s,]+', tokens) if t]
         else:
             password = getpass.getpass('Enter password for {}: '.format(config['login_or_token']))
             if password:
@@ -98,12 +169,29 @@ def main():
         config['password'] = args.password
 
     LOGGER.debug("Github config: %r", config)
+    if config.get('password'):
+        SESSION.auth = (config['login_or_token'], config['password'])
+    config['base_url'] = args.api_url
+    config['pool_size'] = pool_size
+    config['per_page'] = 100
+    if args.http_timeout:
+        config['timeout'] = args.http_timeout
     global gh
     gh = github.Github(**config)
+    SCHEDULER.add_client(gh)
+    for token in extra_tokens:
+        SCHEDULER.add_client(github.Github(token, base_url=args.api_url, pool_size=pool_size, per_page=100,
+                                           timeout=config.get('timeout', github.Consts.DEFAULT_TIMEOUT)))
+    if extra_tokens:
+        LOGGER.info("Spreading API calls over %d tokens", len(extra_tokens) + 1)
 
     # Check that backup dir exists
     if not os.path.exists(args.backupdir):
         mkdir_p(args.backupdir)
+    HTTP_CACHE = HttpCache(os.path.join(args.backupdir, 'http-cache.json'))
+    STORE = METADATA_STORES[args.metadata_store](args.backupdir)
+    if args.dedupe_assets:
+        ASSET_STORE = AssetStore(args.backupdir)
 
     if args.organization:
         if args.password:
@@ -119,7 +207,15 @@ def main():
             account = gh.get_user(args.login_or_token)
 
     IS_AUTHORIZED = isinstance(account, github.AuthenticatedUser.AuthenticatedUser)
-    assert not (bool(config.get('password', None)) ^ IS_AUTHORIZED), account
+    # An organization is never the authenticated account, with credentials or without
+    assert args.organization or not (bool(config.get('password', None)) ^ IS_AUTHORIZED), account
+
+    if args.graphql:
+        if IS_AUTHORIZED:
+            GRAPHQL = GraphQLClient((config['login_or_token'], config['password']), args.graphql_page_size,
+                                    graphql_url(args.api_url))
+        else:
+            LOGGER.info("The GraphQL API needs an authenticated account, using the REST API instead...")
 
     if args.include_keys and not IS_AUTHORIZED:
         LOGGER.info("Cannot backup keys with unauthenticated account, ignoring...")
@@ -133,67 +229,1058 @@ def main():
             'visibility': args.visibility
         }
 
-    if args.account:
-        process_account(gh, account, args)
-
+    if args.verify_shards:
+        return verify_shards(collect_backups(account, args, filters), args)
+
+    if args.daemon:
+        return Daemon(account, args, filters, config).run()
+
+    if args.plan:
+        with METRICS.phase('listing'):
+            backups = select_shard(collect_backups(account, args, filters), args)
+        return write_plan(github.Github(**config), account, backups, args)
+
+    # Account data is only backed up by the first shard
+    if args.account and (not args.shard or args.shard[0] == 1):
+        # Searches get their own client so that their much smaller rate limit
+        # doesn't get mixed up with the core budget of gh
+        with METRICS.phase('account'):
+            process_account(github.Github(**config), account, args)
+
+    with METRICS.phase('listing'):
+        feed = EventFeed(gh, account, args) if args.events else None
+        backups = feed.changed_backups() if feed else None
+        full_sweep = backups is None
+        if full_sweep:
+            backups = collect_backups(account, args, filters)
+    backups = select_shard(backups, args)
+    if args.execute_plan:
+        backups = planned_backups(backups, args.execute_plan)
+
+    started = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    failures = run_backups(backups, args)
+    if args.shard:
+        write_shard_manifest(backups, failures, started, args)
+    if feed:
+        feed.finish(backups, failures, full_sweep)
+    if args.dedupe_forks:
+        repack_networks()
+    if ASSET_STORE:
+        ASSET_STORE.save()
+    HTTP_CACHE.save()
+    STORE.close()
+    LOGGER.info("Wrote %d JSON files, %d were unchanged", JSON_WRITER.written, JSON_WRITER.skipped)
+    LOGGER.info("Made %d requests, waited %.0f seconds for the rate limit and %.0f seconds between requests",
+                sum(METRICS.requests.values()), METRICS.counters['rate_limit_wait_seconds'],
+                METRICS.counters['request_throttle_seconds'])
+    write_reports(args, len(backups), failures)
+    if GRAPHQL:
+        LOGGER.info("GraphQL queries cost %d points", GRAPHQL.cost)
+    if METRICS.timeouts:
+        LOGGER.warning("%d operations timed out:", len(METRICS.timeouts))
+        for timeout in METRICS.timeouts:
+            LOGGER.warning("    %s %s", timeout['operation'], timeout['reason'])
+    if failures:
+        LOGGER.error("%d of %d backups failed:", len(failures), len(backups))
+        for name, exc in failures:
+            LOGGER.error("    %s: %s", name, exc)
+        return 1
+
+    LOGGER.info("All %d backups completed successfully", len(backups))
+    return 0
+
+def collect_backups(account, args, filters):
+    """Return a RepositoryBackup for every gist and repository selected by args."""
+    backups = []
     if args.include_gists:
         for gist in get_account_gists(account):
-            RepositoryBackup(gist, args).backup()
+            backups.append(RepositoryBackup(gist, args))
 
     if args.include_starred_gists and hasattr(account, 'get_starred_gists'):
         for gist in get_account_starred_gists(account):
-            RepositoryBackup(gist, args).backup()
+            backups.append(RepositoryBackup(gist, args))
 
     if not args.skip_repos:
-        repos = get_account_repos(account, **filters) 
+        repos = get_account_repos(account, **filters)
         for repo in repos:
             if args.skip_forks and repo.fork:
                 continue
 
-            RepositoryBackup(repo, args).backup()
+            backups.append(RepositoryBackup(repo, args))
+
+    return backups
+
+# Rate limits per token and hour, see
+# https://docs.github.com/en/rest/overview/rate-limits-for-the-rest-api
+REST_REQUESTS_PER_HOUR = 5000
+SEARCH_REQUESTS_PER_HOUR = 30 * 60
+GRAPHQL_POINTS_PER_HOUR = 5000
+
+def count_listing(owner, url):
+    """Return the number of items in a list endpoint, with a single one-item request."""
+    url += ('&' if '?' in url else '?') + 'per_page=1'
+    resp = conditional_get(url, False, owner)
+    resp.raise_for_status()
+    last = resp.links.get('last', {}).get('url')
+    if last:
+        match = re.search(r'[?&]page=(\d+)', last)
+        if match:
+            return int(match.group(1))
+    return len(resp.json())
+
+def write_plan(search_gh, account, backups, args):
+    """Estimate what a backup of backups would do and cost, and write the plan to args.plan."""
+    LOGGER.info("Planning the backup of %d repositories and gists", len(backups))
+    items = []
+    for backup in backups:
+        try:
+            items.append(backup.plan())
+        except Exception:
+            LOGGER.exception("Planning the backup of %s failed", backup.name)
+            items.append({'name': str(backup.name), 'action': 'unknown', 'requests': {}})
+
+    totals = {'rest': 0, 'graphql': 0, 'search': 0}
+    for item in items:
+        for api, count in item['requests'].items():
+            totals[api] += count
+
+    if args.account and (args.include_issues or args.include_pulls) and (not args.shard or args.shard[0] == 1):
+        login = get_account_login(account)
+        for type, selected in (('issue', args.include_issues), ('pr', args.include_pulls)):
+            if not selected:
+                continue
+            for qualifier in ('author', 'assignee'):
+                results = search_gh.search_issues('type:%s %s:%s' % (type, qualifier, login))
+                get_search_page(search_gh, results, 0)
+                pages = int(math.ceil(results.totalCount / 100.0)) or 1
+                # Each window over the cap costs one more query
+                totals['search'] += pages + results.totalCount // SEARCH_MAX_RESULTS
+                totals['rest'] += results.totalCount * (2 if type == 'pr' else 1)
+
+    tokens = max(len(SCHEDULER.clients), 1)
+    hours = {
+        'rest': totals['rest'] / float(REST_REQUESTS_PER_HOUR * tokens),
+        'graphql': totals['graphql'] / float(GRAPHQL_POINTS_PER_HOUR * tokens),
+        'search': totals['search'] / float(SEARCH_REQUESTS_PER_HOUR),
+    }
+    actions = {}
+    for item in items:
+        actions[item['action']] = actions.get(item['action'], 0) + 1
+    plan = {
+        'created': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'account': get_account_login(account),
+        'shard': '%d/%d' % tuple(args.shard) if args.shard else None,
+        'actions': actions,
+        'requests': totals,
+        'rate_limit_hours': dict((api, round(value, 2)) for api, value in hours.items()),
+        'clone_bytes': sum(item.get('clone_bytes', 0) for item in items),
+        'asset_bytes': sum(item.get('asset_bytes', 0) for item in items),
+        'repositories': items,
+    }
+    write_json(args.plan, plan)
+
+    LOGGER.info("Plan written to %s", args.plan)
+    LOGGER.info("    %s", ', '.join('%d to %s' % (count, action) for action, count in sorted(actions.items())))
+    LOGGER.info("    %.1f GB to clone, %.1f GB of release assets to download",
+                plan['clone_bytes'] / 1e9, plan['asset_bytes'] / 1e9)
+    LOGGER.info("    at least %d REST requests (%.1f hours with %d tokens), %d GraphQL points (%.1f hours), "
+                "%d searches (%.1f hours)", totals['rest'], hours['rest'], tokens,
+                totals['graphql'], hours['graphql'], totals['search'], hours['search'])
+    return 0
+
+def planned_backups(backups, path):
+    """Return the backups that the plan in path found work for."""
+    with open(path) as f:
+        plan = json.load(f)
+    planned = set(item['name'] for item in plan['repositories'] if item['action'] != 'unchanged')
+    selected = [backup for backup in backups if str(backup.name) in planned]
+    LOGGER.info("Backing up the %d repositories and gists with work in %s", len(selected), path)
+    return selected
+
+def select_shard(backups, args):
+    """Return the backups assigned to the shard given with --shard."""
+    if not args.shard:
+        return backups
+    index, count = args.shard
+    backups = [backup for backup in backups if shard_of(backup.name, count) == index]
+    LOGGER.info("Backing up %d repositories and gists as shard %d of %d", len(backups), index, count)
+    return backups
+
+class Daemon(object):
+    """Keep backing up the account's repositories, the most overdue first.
+
+    Every repository is due again some time after its last backup: soon after
+    if it was pushed or updated since, or its number of open issues changed,
+    otherwise after a quarter of the time it has been idle, bounded by
+    --daemon-min-interval and --daemon-max-interval. The repositories are
+    listed again every --refresh-interval seconds, or on SIGUSR1.
+
+    Commands are read from a Unix socket, one per line:
+    "backup OWNER/NAME" backs up a repository (or gist id) right away,
+    "refresh" lists the repositories again and "status" shows the queue.
+    """
+
+    def __init__(self, account, args, filters, config):
+        self.account = account
+        self.args = args
+        self.filters = filters
+        self.config = config
+        self.state_file = os.path.join(args.backupdir, 'daemon-state.json')
+        self.last_run = load_state(self.state_file)
+        self.backups = {}
+        self.open_issues = {}
+        self.queue = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.running = set()
+        # The repositories whose last backup failed, for the run report
+        self.failures = {}
+        self.urgent = set()
+        self.cond = threading.Condition()
+        self.refresh_at = 0
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.request_refresh())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        server = self._serve()
+        LOGGER.info("Running as a daemon, listening on %s", self.args.daemon_socket)
+        executor = ThreadPoolExecutor(max_workers=self.args.jobs)
+        try:
+            while not self.stopping:
+                if time.time() >= self.refresh_at:
+                    self.refresh()
+                self._dispatch(executor)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            LOGGER.info("Stopping, waiting for %d running backups", len(self.running))
+            server.shutdown()
+            server.server_close()
+            os.unlink(self.args.daemon_socket)
+            executor.shutdown(wait=True)
+            self._save()
+            if ASSET_STORE:
+                ASSET_STORE.save()
+            HTTP_CACHE.save()
+            STORE.close()
+            write_reports(self.args, len(self.backups), self._failures())
+        return 0
+
+    def stop(self):
+        self.stopping = True
+
+    def request_refresh(self):
+        self.refresh_at = 0
+
+    def refresh(self):
+        """List the account's repositories again and requeue them."""
+        self.refresh_at = time.time() + self.args.refresh_interval
+        try:
+            if self.args.account and (not self.args.shard or self.args.shard[0] == 1):
+                with METRICS.phase('account'):
+                    process_account(github.Github(**self.config), self.account, self.args)
+            with METRICS.phase('listing'):
+                backups = select_shard(collect_backups(self.account, self.args, self.filters), self.args)
+        except Exception:
+            LOGGER.exception("Listing the repositories failed, retrying in %d seconds", self.args.daemon_min_interval)
+            self.refresh_at = time.time() + self.args.daemon_min_interval
+            return
+        with self.cond:
+            self.backups = dict((backup.name, backup) for backup in backups)
+            self.queue = []
+            self.entries = {}
+            for backup in backups:
+                if backup.name not in self.running:
+                    self._schedule(backup)
+            self.cond.notify()
+        if ASSET_STORE:
+            ASSET_STORE.save()
+        HTTP_CACHE.save()
+        STORE.flush()
+        write_reports(self.args, len(backups), self._failures())
+        LOGGER.info("Queued %d repositories and gists", len(backups))
+
+    def backup_now(self, name):
+        """Back up the repository or gist called name as soon as a job is free."""
+        with self.cond:
+            if name not in self.backups:
+                return False
+            self.urgent.add(name)
+            if name not in self.running:
+                self._schedule(self.backups[name], 0)
+            self.cond.notify()
+        return True
+
+    def _due(self, backup):
+        last_run = self.last_run.get(backup.name, 0)
+        raw = backup.repo._rawData
+        active = max(parse_timestamp(raw[key]).timestamp() for key in ('pushed_at', 'updated_at') if raw.get(key))
+        open_issues = raw.get('open_issues_count')
+        churn = self.open_issues.get(backup.name, open_issues) != open_issues
+        self.open_issues[backup.name] = open_issues
+        if active > last_run or churn:
+            return last_run + self.args.daemon_min_interval
+        interval = (time.time() - active) / 4
+        return last_run + min(max(interval, self.args.daemon_min_interval), self.args.daemon_max_interval)
+
+    def _schedule(self, backup, due=None):
+        if due is None:
+            due = self._due(backup)
+        # Entries that are scheduled again are left in the heap, and skipped
+        entry = (due, next(self.counter), backup.name)
+        self.entries[backup.name] = entry
+        heapq.heappush(self.queue, entry)
+
+    def _dispatch(self, executor):
+        """Start the backups that are due, within the free jobs and the API budget."""
+        with self.cond:
+            while self.queue and len(self.running) < self.args.jobs:
+                due, _, name = self.queue[0]
+                if self.entries.get(name) is not self.queue[0]:
+                    heapq.heappop(self.queue)
+                    continue
+                now = time.time()
+                if due > now:
+                    break
+                # Leave a reserve of the API budget for the backups asked for on the socket
+                wait = SCHEDULER.exhausted_until(self.args.daemon_reserve) - now
+                if wait > 0 and name not in self.urgent:
+                    LOGGER.info("API budget is low, waiting %.0f seconds for the reset", wait)
+                    self.cond.wait(max(min(wait, self.refresh_at - now, 60), 0))
+                    return
+                heapq.heappop(self.queue)
+                del self.entries[name]
+                self.urgent.discard(name)
+                self.running.add(name)
+                executor.submit(self._run, self.backups[name])
+            timeout = self.refresh_at - time.time()
+            if self.queue:
+                timeout = min(timeout, self.queue[0][0] - time.time())
+            # Wake up regularly to notice signals
+            self.cond.wait(max(min(timeout, 5), 0))
+
+    def _run(self, backup):
+        start = time.time()
+        due = None
+        try:
+            with METRICS.profile(self.args.profile), METRICS.phase('backup', backup.name):
+                backup.backup()
+        except Exception as exc:
+            LOGGER.exception("Backup of %s failed", backup.name)
+            due = time.time() + self.args.daemon_min_interval
+            failure = exc
+        else:
+            LOGGER.info("Backup of %s finished in %.1fs", backup.name, time.time() - start)
+            failure = None
+        with self.cond:
+            self.running.discard(backup.name)
+            if failure:
+                self.failures[backup.name] = failure
+            else:
+                self.failures.pop(backup.name, None)
+            if due is None:
+                self.last_run[backup.name] = start
+            if backup.name in self.urgent:
+                self._schedule(self.backups[backup.name], 0)
+            elif backup.name in self.backups:
+                self._schedule(self.backups[backup.name], due)
+            self._save()
+            self.cond.notify()
+
+    def _save(self):
+        write_json(self.state_file, self.last_run)
+
+    def _failures(self):
+        with self.cond:
+            return sorted(self.failures.items())
+
+    def status(self):
+        with self.cond:
+            lines = ['running %s' % name for name in sorted(self.running)]
+            for due, _, name in sorted(self.entries.values())[:20]:
+                lines.append('%s %s' % (datetime.fromtimestamp(due, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'), name))
+            lines.append('%d queued, next refresh in %.0f seconds' % (len(self.entries), self.refresh_at - time.time()))
+        return lines
+
+    def _serve(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    words = line.decode('utf-8', 'replace').split()
+                    if not words:
+                        continue
+                    if words[0] == 'backup' and len(words) == 2:
+                        if daemon.backup_now(words[1]):
+                            reply = ['queued %s' % words[1]]
+                        else:
+                            reply = ['error: unknown repository %s' % words[1]]
+                    elif words[0] == 'refresh':
+                        daemon.request_refresh()
+                        reply = ['refreshing']
+                    elif words[0] == 'status':
+                        reply = daemon.status()
+                    else:
+                        reply = ['error: unknown command %s' % words[0]]
+                    self.wfile.write(''.join(l + '\n' for l in reply).encode('utf-8'))
+
+        if os.path.exists(self.args.daemon_socket):
+            os.unlink(self.args.daemon_socket)
+        server = socketserver.ThreadingUnixStreamServer(self.args.daemon_socket, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+class EventFeed(object):
+    """Find the repositories that changed since the last run from the account's event feed.
+
+    The id of the newest event seen is kept in events-state.json along with
+    the repositories found by the last full sweep. Only events on those
+    repositories (and repositories the account creates) are acted upon.
+    """
+
+    EVENT_TYPES = (
+        'CreateEvent', 'DeleteEvent', 'GollumEvent', 'IssueCommentEvent',
+        'IssuesEvent', 'PublicEvent', 'PullRequestEvent',
+        'PullRequestReviewCommentEvent', 'PullRequestReviewEvent',
+        'PushEvent', 'ReleaseEvent',
+    )
+
+    def __init__(self, gh, account, args):
+        self.gh = gh
+        self.args = args
+        self.login = get_account_login(account)
+        if isinstance(account, github.Organization.Organization) and SESSION.auth:
+            # The organization's own feed only has the events of its public
+            # repositories, a member's view of it has the private ones too
+            self.url = '%s/users/%s/events/orgs/%s' % (gh.requester.base_url, get_account_login(gh.get_user()),
+                                                      self.login)
+        elif isinstance(account, github.Organization.Organization):
+            self.url = '%s/orgs/%s/events' % (gh.requester.base_url, self.login)
+        elif IS_AUTHORIZED:
+            # Only what the user did themselves, not what others did on their repositories
+            self.url = '%s/users/%s/events' % (gh.requester.base_url, self.login)
+        else:
+            self.url = '%s/users/%s/events/public' % (gh.requester.base_url, self.login)
+        self.state_file = os.path.join(args.backupdir, 'events-state.json')
+        self.state = load_state(self.state_file)
+        self.newest = self.state.get('last_event_id')
+        self.first_page = None
+
+    def changed_backups(self):
+        """Return backups of the repositories with new events, or None if a full sweep is needed."""
+        changed = self._poll()
+        last_sweep = self.state.get('last_full_sweep')
+        if last_sweep is None or 'repos' not in self.state:
+            LOGGER.info("No full sweep recorded yet, backing up everything")
+            return None
+        if time.time() - parse_timestamp(last_sweep).timestamp() > self.args.full_sweep_interval * 3600:
+            LOGGER.info("Last full sweep was at %s, backing up everything", last_sweep)
+            return None
+        if changed is None:
+            LOGGER.info("The event feed doesn't reach back to the last run, backing up everything")
+            return None
+
+        names = (changed & set(self.state['repos'])) | set(self.state.get('pending', []))
+        names |= self.created
+        LOGGER.info("%d repositories changed since the last run", len(names))
+        backups = []
+        for name in sorted(names):
+            try:
+                repo = get_repo(self.gh, name)
+            except github.UnknownObjectException:
+                LOGGER.info("Repository %s is gone, skipping it", name)
+                continue
+            if self.args.skip_forks and repo.fork:
+                continue
+            backups.append(RepositoryBackup(repo, self.args))
+        return backups
+
+    def _poll(self):
+        """Return the names of the repositories with events since the last poll.
+
+        Returns None when the feed (which only keeps the last 300 events)
+        doesn't go back far enough.
+        """
+        last = self.state.get('last_event_id')
+        changed = set()
+        self.created = set()
+        url = self.url + '?per_page=100'
+        conditional = last is not None
+        while url:
+            resp = conditional_get(url, conditional, self.gh)
+            if resp.status_code == 304:
+                return changed
+            resp.raise_for_status()
+            if self.first_page is None:
+                self.first_page = (url, resp)
+            conditional = False
+            for event in resp.json():
+                if self.newest is None or int(event['id']) > int(self.newest):
+                    self.newest = event['id']
+                if last and int(event['id']) <= int(last):
+                    return changed
+                if event['type'] not in self.EVENT_TYPES:
+                    continue
+                name = event['repo']['name']
+                changed.add(name)
+                if event['type'] == 'CreateEvent' and event['payload'].get('ref_type') == 'repository' \
+                   and name.split('/')[0] == self.login:
+                    self.created.add(name)
+            url = resp.links.get('next', {}).get('url')
+        return None if last else changed
+
+    def finish(self, backups, failures, full_sweep):
+        """Remember the newest event, and retry the failed repositories next time."""
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if full_sweep:
+            self.state['last_full_sweep'] = now
+            self.state['repos'] = sorted(backup.name for backup in backups if not backup.is_gist)
+        else:
+            self.state['repos'] = sorted(set(self.state['repos']) | self.created)
+        self.state['pending'] = sorted(name for name, exc in failures)
+        self.state['last_event_id'] = self.newest
+        self.state['last_poll'] = now
+        write_json(self.state_file, self.state)
+        if self.first_page:
+            HTTP_CACHE.store(*self.first_page)
+
+def parse_shard(value):
+    """Parse INDEX/COUNT, with INDEX counting from 1."""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ArgumentTypeError("expected INDEX/COUNT, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise ArgumentTypeError("INDEX must be between 1 and COUNT")
+    return index, count
+
+def shard_of(name, count):
+    """Assign name to one of count shards by rendezvous hashing.
+
+    A name's shard only depends on the name itself, so adding or removing
+    repositories never moves the others, and adding a shard only moves the
+    names the new shard takes over.
+    """
+    def weight(shard):
+        return hashlib.sha1(('%s/%d' % (name, shard)).encode('utf-8')).digest()
+    return max(range(1, count + 1), key=weight)
+
+def shard_manifest_path(backupdir, index, count):
+    return os.path.join(backupdir, 'shards', 'shard-%d-of-%d.json' % (index, count))
+
+def write_shard_manifest(backups, failures, started, args):
+    """Record which repositories and gists this shard backed up."""
+    index, count = args.shard
+    failed = set(name for name, exc in failures)
+    write_json(shard_manifest_path(args.backupdir, index, count), {
+        'shard': index,
+        'count': count,
+        'started': started,
+        'finished': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'completed': sorted(backup.name for backup in backups if backup.name not in failed),
+        'failed': sorted(failed),
+    })
+
+def verify_shards(backups, args):
+    """Check that the shard manifests in args.verify_shards cover every backup.
+
+    Writes the merged result to shards/merged.json and returns the exit code.
+    """
+    manifests = {}
+    for path in glob.glob(os.path.join(args.verify_shards, 'shard-*-of-*.json')):
+        manifest = load_state(path)
+        manifests.setdefault(manifest['count'], {})[manifest['shard']] = manifest
+    if not manifests:
+        LOGGER.error("No shard manifests found in %s", args.verify_shards)
+        return 1
+    count = max(manifests)
+    if len(manifests) > 1:
+        LOGGER.warning("Ignoring manifests of other shard counts than %d", count)
+    manifests = manifests[count]
+
+    completed = {}
+    for index, manifest in manifests.items():
+        for name in manifest['completed']:
+            completed[name] = index
+    missing_shards = sorted(set(range(1, count + 1)) - set(manifests))
+    missing = sorted(backup.name for backup in backups if backup.name not in completed)
+    misplaced = sorted(backup.name for backup in backups
+                       if backup.name in completed and completed[backup.name] != shard_of(backup.name, count))
+
+    write_json(os.path.join(args.backupdir, 'shards', 'merged.json'), {
+        'count': count,
+        'total': len(backups),
+        'completed': len(backups) - len(missing),
+        'missing_shards': missing_shards,
+        'missing': missing,
+        'misplaced': misplaced,
+    })
+    for index in missing_shards:
+        LOGGER.error("No manifest for shard %d of %d", index, count)
+    for name in missing:
+        LOGGER.error("%s was not backed up by shard %d", name, shard_of(name, count))
+    for name in misplaced:
+        LOGGER.warning("%s was backed up by shard %d instead of %d", name, completed[name], shard_of(name, count))
+    if missing_shards or missing:
+        return 1
+    LOGGER.info("All %d repositories and gists are covered by the %d shards", len(backups), count)
+    return 0
+
+def api_endpoint(url):
+    """Return the path of an API url with owner, repository and ids replaced by placeholders."""
+    parts = urlsplit(url).path.strip('/').split('/')
+    if parts[:2] == ['api', 'v3']:
+        parts = parts[2:]
+    if parts[0] == 'repos' and len(parts) >= 3:
+        parts[1:3] = [':owner', ':repo']
+    elif parts[0] in ('users', 'orgs') and len(parts) >= 2:
+        parts[1] = ':' + parts[0][:-1]
+    parts = [':id' if part.isdigit() or re.match(r'^[0-9a-f]{40}$', part) else part for part in parts]
+    return '/' + '/'.join(parts)
+
+class Metrics(object):
+    """Timings and counters of a run, for the run report and the Prometheus textfile.
+
+    Phases are timed per repository as well as in total. They can nest:
+    assets are part of releases, and json-write is part of whichever phase
+    saved the file.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.git = {}
+        self.repositories = {}
+        self.requests = {}
+        self.counters = {'rate_limit_wait_seconds': 0.0, 'request_throttle_seconds': 0.0, 'downloaded_bytes': 0}
+        self.timeouts = []
+        self.profiles = []
+        # The blocks in Metrics.profile() sharing shared_profile
+        self.profiled = 0
+        self.shared_profile = None
+
+    def add(self, counter, value):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def request(self, endpoint, size=0):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.counters['downloaded_bytes'] += size
+
+    def observe(self, timings, name, seconds):
+        with self.lock:
+            count, total = timings.get(name, (0, 0.0))
+            timings[name] = (count + 1, total + seconds)
+
+    def timeout(self, kind, what, reason):
+        with self.lock:
+            self.timeouts.append({'kind': kind, 'operation': what, 'reason': reason,
+                                  'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')})
+
+    @contextlib.contextmanager
+    def phase(self, name, repository=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.observe(self.phases, name, seconds)
+            if repository is not None:
+                with self.lock:
+                    phases = self.repositories.setdefault(str(repository), {})
+                    phases[name] = phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def profile(self, enabled):
+        """Profile the block with cProfile, if enabled.
+
+        Before Python 3.12 a profiler only sees the thread that enabled it, so
+        every block gets its own. Since then it sees the whole process and only
+        one may be enabled at a time, so concurrent blocks share it.
+        """
+        if not enabled:
+            yield
+            return
+        if sys.version_info < (3, 12):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.profiles.append(profile)
+            return
+        with self.lock:
+            if not self.profiled:
+                self.shared_profile = cProfile.Profile()
+                self.shared_profile.enable()
+            self.profiled += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.profiled -= 1
+                if not self.profiled:
+                    self.shared_profile.disable()
+                    self.profiles.append(self.shared_profile)
+
+    def report(self, backups, failures):
+        with self.lock:
+            return {
+                'started': datetime.fromtimestamp(self.started, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'duration_seconds': round(time.time() - self.started, 3),
+                'backups': backups,
+                'failures': dict((str(name), str(exc)) for name, exc in failures),
+                'phases': dict((name, {'count': count, 'seconds': round(seconds, 3)})
+                               for name, (count, seconds) in self.phases.items()),
+                'git_commands': dict((name, {'count': count, 'seconds': round(seconds, 3)})
+                                     for name, (count, seconds) in self.git.items()),
+                'repositories': dict((name, dict((phase, round(seconds, 3)) for phase, seconds in phases.items()))
+                                     for name, phases in self.repositories.items()),
+                'api_requests': dict(self.requests),
+                'api_requests_total': sum(self.requests.values()),
+                'rate_limit_wait_seconds': round(self.counters['rate_limit_wait_seconds'], 3),
+                'request_throttle_seconds': round(self.counters['request_throttle_seconds'], 3),
+                'downloaded_bytes': self.counters['downloaded_bytes'],
+                'timeouts': list(self.timeouts),
+                'json_files_written': JSON_WRITER.written,
+                'json_files_unchanged': JSON_WRITER.skipped,
+            }
+
+    def prometheus(self, backups, failures):
+        """Return the run's metrics in the Prometheus text exposition format."""
+        report = self.report(backups, failures)
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP github_backup_%s %s' % (name, help))
+            lines.append('# TYPE github_backup_%s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in labels)
+                lines.append('github_backup_%s%s %s' % (name, '{%s}' % label_text if labels else '', value))
+
+        metric('last_run_timestamp_seconds', 'gauge', 'When the last run started.', [((), self.started)])
+        metric('run_duration_seconds', 'gauge', 'How long the last run took.', [((), report['duration_seconds'])])
+        metric('backups', 'gauge', 'Repositories and gists backed up by the last run.', [((), backups)])
+        metric('backup_failures', 'gauge', 'Backups that failed in the last run.', [((), len(failures))])
+        metric('phase_seconds', 'gauge', 'Time spent in each phase of the last run.',
+               [((('phase', name),), value['seconds']) for name, value in sorted(report['phases'].items())])
+        metric('git_command_seconds', 'gauge', 'Time spent in each git command in the last run.',
+               [((('command', name),), value['seconds']) for name, value in sorted(report['git_commands'].items())])
+        metric('api_requests', 'gauge', 'API requests made by the last run.',
+               [((('endpoint', name),), value) for name, value in sorted(report['api_requests'].items())])
+        metric('rate_limit_wait_seconds', 'gauge', 'Time spent waiting for the rate limit in the last run.',
+               [((), report['rate_limit_wait_seconds'])])
+        metric('request_throttle_seconds', 'gauge', 'Time PyGithub spent spacing out requests in the last run.',
+               [((), report['request_throttle_seconds'])])
+        metric('downloaded_bytes', 'gauge', 'Bytes downloaded from the API and release assets in the last run.',
+               [((), report['downloaded_bytes'])])
+        kinds = sorted(set(timeout['kind'] for timeout in report['timeouts']))
+        metric('timeouts', 'gauge', 'Git commands and HTTP requests that timed out or stalled in the last run.',
+               [((('kind', kind),), sum(1 for timeout in report['timeouts'] if timeout['kind'] == kind))
+                for kind in kinds])
+        metric('json_files_written', 'gauge', 'JSON files written by the last run.', [((), report['json_files_written'])])
+        return '\n'.join(lines) + '\n'
+
+    def dump_profile(self, path):
+        with self.lock:
+            if not self.profiles:
+                return
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+        stats.dump_stats(path)
+
+METRICS = Metrics()
+
+class RequestCounter(logging.Handler):
+    """Count the API requests PyGithub logs, and the time it waits between them."""
+
+    def emit(self, record):
+        # See Requester.__log: verb, scheme, hostname, url, headers, input, status, headers, output
+        if isinstance(record.args, tuple) and len(record.args) == 9:
+            url, output = record.args[3], record.args[8]
+            METRICS.request(api_endpoint(url), len(output) if isinstance(output, str) else 0)
+            return
+        match = re.match(r'sleeping ([0-9.e-]+)s before next GitHub request', str(record.msg))
+        if match:
+            METRICS.add('request_throttle_seconds', float(match.group(1)))
+
+def count_response(resp, stream=False, **kwargs):
+    """Count the requests made with SESSION; downloads count their bytes in fetch_url."""
+    if stream:
+        METRICS.request('download')
+    else:
+        METRICS.request(api_endpoint(resp.url), len(resp.content))
+
+def write_reports(args, backups, failures):
+    """Write the run report, the Prometheus textfile and the profile asked for on the command line."""
+    if args.report:
+        write_json(args.report, METRICS.report(backups, failures))
+    if args.prometheus_file:
+        # The textfile collector may read it at any time, so replace it atomically
+        tmp_path = '%s.%d.tmp' % (args.prometheus_file, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(METRICS.prometheus(backups, failures))
+        os.replace(tmp_path, args.prometheus_file)
+    if args.profile:
+        METRICS.dump_profile(args.profile)
+
+def run_backups(backups, args):
+    """Run the backups, up to args.jobs at a time, and return the failures."""
+    failures = []
+
+    def run(backup):
+        start = time.time()
+        try:
+            with METRICS.profile(args.profile), METRICS.phase('backup', backup.name):
+                backup.backup()
+        except Exception as exc:
+            LOGGER.exception("Backup of %s failed", backup.name)
+            failures.append((backup.name, exc))
+        else:
+            LOGGER.info("Backup of %s finished in %.1fs", backup.name, time.time() - start)
+
+    if args.jobs > 1:
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            list(executor.map(run, backups))
+    else:
+        for backup in backups:
+            run(backup)
+
+    return failures
+
+class RateLimitBudget(object):
+    """The API budget of one token for one rate limit resource."""
+
+    def __init__(self):
+        self.remaining = None
+        self.limit = None
+        self.reset = 0
+        self.blocked_until = 0
+        self.next_call = 0
+
+    def headroom(self):
+        if time.time() < self.blocked_until:
+            return 0
+        if self.remaining is None or time.time() > self.reset:
+            return self.limit or 5000
+        return self.remaining
+
+class RateLimitScheduler(object):
+    """Pace API calls so that every token spends its budget evenly until the reset.
+
+    The budgets are updated from the X-RateLimit-* headers PyGithub records for
+    each response. Calls are not delayed while a token still has more than half
+    of its budget left; after that they are spaced out to last until the reset.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = []
+        self.budgets = {}
+
+    def add_client(self, client):
+        self.clients.append(client)
+
+    def pick(self):
+        """Return the client whose core budget has the most headroom."""
+        with self.lock:
+            return max(self.clients, key=lambda client: self._budget(client.requester, 'core').headroom())
+
+    def budget_for(self, obj, resource):
+        requester = getattr(obj, 'requester', None)
+        if requester is None:
+            return None
+        with self.lock:
+            return self._budget(requester, resource)
+
+    def _budget(self, requester, resource):
+        key = (id(requester), resource)
+        if key not in self.budgets:
+            self.budgets[key] = (requester, RateLimitBudget())
+        return self.budgets[key][1]
+
+    def exhausted_until(self, reserve):
+        """Return when some token will have more than reserve core calls left, or 0 if one has now."""
+        with self.lock:
+            budgets = [self._budget(client.requester, 'core') for client in self.clients]
+            if not budgets or any(budget.headroom() > reserve for budget in budgets):
+                return 0
+            return min(max(budget.reset, budget.blocked_until) for budget in budgets)
+
+    def wait(self, budget):
+        with self.lock:
+            now = time.time()
+            start = max(now, budget.blocked_until, budget.next_call)
+            budget.next_call = start
+            if budget.remaining is not None and budget.limit and budget.reset > start \
+               and budget.remaining < budget.limit / 2:
+                budget.next_call = start + (budget.reset - start) / max(budget.remaining, 1)
+        if start > now:
+            LOGGER.debug("Pacing API calls, waiting for %.1f seconds", start - now)
+            METRICS.add('rate_limit_wait_seconds', start - now)
+            time.sleep(start - now)
+
+    def update(self, budget, requester):
+        remaining, limit = requester.rate_limiting
+        if remaining < 0:
+            return
+        with self.lock:
+            budget.remaining, budget.limit = remaining, limit
+            budget.reset = requester.rate_limiting_resettime
+
+    def update_from_headers(self, budget, headers):
+        """Update the budget from the X-RateLimit-* headers of a response PyGithub didn't see."""
+        if 'X-RateLimit-Remaining' not in headers or headers.get('X-RateLimit-Resource', 'core') != 'core':
+            return
+        with self.lock:
+            budget.remaining = int(headers['X-RateLimit-Remaining'])
+            budget.limit = int(headers.get('X-RateLimit-Limit', 0)) or budget.limit
+            budget.reset = int(headers.get('X-RateLimit-Reset', 0)) or budget.reset
+
+    def backoff(self, budget, headers):
+        """Block the budget until the limit that a response with headers ran into is over."""
+        headers = dict((k.lower(), v) for k, v in (headers or {}).items())
+        if headers.get('retry-after'):
+            until = time.time() + int(headers['retry-after'])
+        elif headers.get('x-ratelimit-remaining') == '0' and headers.get('x-ratelimit-reset'):
+            until = int(headers['x-ratelimit-reset']) + 30
+        else:
+            # Secondary rate limit without a hint, see
+            # https://docs.github.com/en/rest/overview/rate-limits-for-the-rest-api
+            until = time.time() + 60
+        # The wait itself happens, and is added to the metrics, in wait()
+        LOGGER.warning("Rate limit exceeded, waiting for %.0f seconds...", max(until - time.time(), 0))
+        with self.lock:
+            budget.blocked_until = max(budget.blocked_until, until)
+
+SCHEDULER = RateLimitScheduler()
 
-def rate_limited_retry():
+def rate_limited_retry(resource='core'):
     def decorator(func):
         def ret(*args, **kwargs):
-            for _ in range(3):
+            budget = SCHEDULER.budget_for(args[0], resource) if args else None
+            if budget is None:
+                budget = RateLimitBudget()
+            for attempt in range(3):
+                SCHEDULER.wait(budget)
                 try:
-                    return func(*args, **kwargs)
-                except RateLimitExceededException:
-                    limits = gh.get_rate_limit()
-                    print(f"Rate limit exceeded")
-                    print("Search:", limits.search, "Core:", limits.core, "GraphQl:", limits.graphql)
-                    
-                    if limits.search.remaining == 0:
-                        limited = limits.search
-                    elif limits.graphql.remaining == 0:
-                        limited = limits.graphql
-                    else:
-                        limited = limits.core
-                    reset = limited.reset.replace(tzinfo=timezone.utc)
-                    now = datetime.now(timezone.utc)
-                    seconds = (reset - now).total_seconds() + 30
-                    print(f"Reset is in {seconds} seconds.")
-                    if seconds > 0.0:
-                        print(f"Waiting for {seconds} seconds...")
-                        time.sleep(seconds)
-                        print("Done waiting - resume!")
+                    with API_SLOTS:
+                        return func(*args, **kwargs)
+                except RateLimitExceededException as exc:
+                    SCHEDULER.backoff(budget, exc.headers)
+                except requests.exceptions.Timeout as exc:
+                    WATCHDOG.stalled('api', func.__name__, 'timed out: %s' % exc)
+                    WATCHDOG.pause(attempt)
+                finally:
+                    if args and getattr(args[0], 'requester', None):
+                        SCHEDULER.update(budget, args[0].requester)
             raise Exception("Failed too many times")
         return ret
     return decorator
 
 @rate_limited_retry()
-def get_search_issues(gh, author, type):
-    _issues = list(gh.search_issues('', author=author, type=type))
-    return _issues
+def get_page(owner, paginated_list, page):
+    return paginated_list.get_page(page)
+
+@rate_limited_retry('search')
+def get_search_page(owner, paginated_list, page):
+    return paginated_list.get_page(page)
+
+def iterate_pages(owner, paginated_list, get_page=get_page, max_items=None, page=0):
+    """Yield the items of a PaginatedList of owner's, one page at a time.
+
+    Each page is fetched and retried on its own, so a rate limit in the
+    middle of a long listing resumes at the page that failed.
+    """
+    per_page = owner.requester.per_page
+    while True:
+        items = get_page(owner, paginated_list, page)
+        for item in items:
+            yield item
+        page += 1
+        if len(items) < per_page or (max_items and page * per_page >= max_items):
+            return
+
+# The search API returns at most this many results per query
+SEARCH_MAX_RESULTS = 1000
+
+# No issue on GitHub was created before this
+SEARCH_EPOCH = datetime(2008, 1, 1, tzinfo=timezone.utc)
+
+def get_search_issues(gh, login, type):
+    """Yield the issues or pull requests (type 'issue' or 'pr') login created or is assigned to, once each."""
+    seen = set()
+    for qualifier in ('author', 'assignee'):
+        query = 'type:%s %s:%s' % (type, qualifier, login)
+        for issue in search_issues_by_window(gh, query, SEARCH_EPOCH, datetime.now(timezone.utc)):
+            if issue.id not in seen:
+                seen.add(issue.id)
+                yield issue
+
+def search_issues_by_window(gh, query, start, end):
+    """Yield the results of an issue search created between start and end.
+
+    If the window has more results than one search can return, it is split
+    into smaller created: windows, in proportion to the number of results.
+    """
+    window = '%s created:%s..%s' % (query, start.strftime('%Y-%m-%dT%H:%M:%SZ'), end.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    results = gh.search_issues(window)
+    first_page = get_search_page(gh, results, 0)
+    total = results.totalCount
+    if total > SEARCH_MAX_RESULTS and end - start > timedelta(seconds=1):
+        parts = int(math.ceil(total / (SEARCH_MAX_RESULTS * 0.8)))
+        step = (end - start) / parts
+        LOGGER.info("    %d results for %s, splitting it into %d windows", total, window, parts)
+        for i in range(parts):
+            part_start = start + step * i
+            if i:
+                part_start = part_start.replace(microsecond=0) + timedelta(seconds=1)
+            part_end = end if i == parts - 1 else (start + step * (i + 1)).replace(microsecond=0)
+            if part_end >= part_start:
+                for issue in search_issues_by_window(gh, query, part_start, part_end):
+                    yield issue
+        return
+    if total > SEARCH_MAX_RESULTS:
+        LOGGER.warning("    %d results for %s, only the first %d can be fetched", total, window, SEARCH_MAX_RESULTS)
+
+    for issue in first_page:
+        yield issue
+    if len(first_page) == gh.requester.per_page:
+        for issue in iterate_pages(gh, results, get_search_page, SEARCH_MAX_RESULTS, page=1):
+            yield issue
 
 @rate_limited_retry()
-def get_issue_comments(issue):
+def get_issue_comments(issue, since=None):
+    if since:
+        return list(issue.get_comments(since=since))
     return list(issue.get_comments())
 
 @rate_limited_retry()
 def get_issue_events(issue):
     return list(issue.get_events())
 
+def get_repo_issues_comments(repo, since=None):
+    if since:
+        return iterate_pages(repo, repo.get_issues_comments(since=since))
+    return iterate_pages(repo, repo.get_issues_comments())
+
+def get_repo_issues_events(repo):
+    return iterate_pages(repo, repo.get_issues_events())
+
+def get_repo_pulls_comments(repo, since=None):
+    if since:
+        return iterate_pages(repo, repo.get_pulls_comments(since=since))
+    return iterate_pages(repo, repo.get_pulls_comments())
+
 @rate_limited_retry()
 def get_issue_as_pull_request(issue):
     return issue.as_pull_request()
@@ -210,13 +1297,18 @@ def get_repo_releases(repo):
 def get_release_assets(release):
     return list(release.get_assets())
 
-@rate_limited_retry()
-def get_repo_issues(repo, state):
-    return list(repo.get_issues(state=state))
+def get_repo_issues(repo, state, since=None):
+    if since:
+        return iterate_pages(repo, repo.get_issues(state=state, since=since))
+    return iterate_pages(repo, repo.get_issues(state=state))
 
-@rate_limited_retry()
-def get_repo_pulls(repo, state):
-    return list(repo.get_pulls(state=state))
+def get_repo_pulls(repo, state, since=None):
+    if since:
+        # The pulls endpoint has no since parameter, so walk the most recently
+        # updated ones first and stop at the first that is already backed up
+        pulls = iterate_pages(repo, repo.get_pulls(state=state, sort='updated', direction='desc'))
+        return itertools.takewhile(lambda pull: pull.updated_at >= since, pulls)
+    return iterate_pages(repo, repo.get_pulls(state=state))
 
 @rate_limited_retry()
 def get_account_login(account):
@@ -238,6 +1330,11 @@ def get_commit_raw_data(commit):
 def get_repo_raw_data(repo):
     return repo.raw_data
 
+def get_listed_raw_data(obj):
+    # Listing endpoints already return the full object, so don't let
+    # raw_data complete it with another request
+    return obj._rawData
+
 @rate_limited_retry()
 def get_event_raw_data(event):
     return event.raw_data
@@ -286,9 +1383,355 @@ def get_account_gists(account):
 def get_account_starred_gists(account):
     return list(account.get_starred_gists())
 
-@rate_limited_retry()
 def get_account_repos(account, **filters):
-    return list(account.get_repos(**filters))
+    return iterate_pages(account, account.get_repos(**filters))
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+def graphql_url(api_url):
+    """Return the GraphQL endpoint next to the REST API at api_url."""
+    api_url = api_url.rstrip('/')
+    # GitHub Enterprise Server serves REST at /api/v3 and GraphQL at /api/graphql
+    if api_url.endswith('/v3'):
+        return api_url[:-len('/v3')] + '/graphql'
+    return api_url + '/graphql'
+
+GRAPHQL_PAGE_INFO = 'pageInfo { hasNextPage endCursor }'
+
+GRAPHQL_COMMENT_FIELDS = '''
+    id databaseId body createdAt updatedAt url authorAssociation author { login }
+'''
+
+GRAPHQL_REVIEW_COMMENT_FIELDS = GRAPHQL_COMMENT_FIELDS + '''
+    path diffHunk position originalPosition commit { oid } originalCommit { oid }
+    replyTo { databaseId }
+'''
+
+GRAPHQL_COMMIT_FIELDS = '''
+    commit {
+        oid message url
+        author { name email date }
+        committer { name email date }
+    }
+'''
+
+GRAPHQL_EVENT_TYPES = (
+    'AssignedEvent', 'ClosedEvent', 'DemilestonedEvent', 'LabeledEvent',
+    'LockedEvent', 'MilestonedEvent', 'ReferencedEvent',
+    'RenamedTitleEvent', 'ReopenedEvent', 'UnassignedEvent',
+    'UnlabeledEvent', 'UnlockedEvent',
+)
+
+GRAPHQL_EVENT_FIELDS = '__typename ... on Node { id } ' + ' '.join(
+    '... on %s { actor { login } createdAt }' % t for t in GRAPHQL_EVENT_TYPES) + '''
+    ... on LabeledEvent { label { name } }
+    ... on UnlabeledEvent { label { name } }
+    ... on RenamedTitleEvent { previousTitle currentTitle }
+    ... on ClosedEvent { closer { ... on Commit { oid } } }
+    ... on ReferencedEvent { commit { oid } }
+'''
+
+GRAPHQL_ISSUE_FIELDS = '''
+    id databaseId number title body state createdAt updatedAt closedAt url locked
+    author { login }
+    labels(first: 100) { nodes { name color description } }
+    assignees(first: 100) { nodes { login } }
+    milestone { number title state }
+    commentCount: comments { totalCount }
+'''
+
+GRAPHQL_PULL_FIELDS = GRAPHQL_ISSUE_FIELDS + '''
+    merged mergedAt isDraft additions deletions changedFiles
+    baseRefName baseRefOid headRefName headRefOid mergeCommit { oid }
+    commitCount: commits { totalCount }
+'''
+
+class GraphQLClient(object):
+    """Fetch issues and pull requests through the GitHub GraphQL API.
+
+    Nodes are returned normalized to the JSON the REST backend saves. The
+    GraphQL point budget is tracked here, separately from the REST budget
+    that rate_limited_retry looks after.
+    """
+
+    # Review comments are nested two connections deep. A query may reach at
+    # most 500,000 nodes, and 100 pull requests x 100 reviews x 10 comments
+    # stays well below that; reviews with more are completed with follow-ups
+    REVIEW_COMMENTS_PAGE_SIZE = 10
+
+    def __init__(self, auth, page_size=50, url=GRAPHQL_URL):
+        self.auth = auth
+        self.page_size = page_size
+        self.url = url
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset_at = None
+        self.cost = 0
+
+    def query(self, query, variables):
+        for attempt in range(3):
+            self._wait_for_budget()
+            try:
+                with API_SLOTS:
+                    resp = SESSION.post(self.url, auth=self.auth,
+                                        json={'query': query, 'variables': variables},
+                                        timeout=WATCHDOG.http_timeout)
+            except requests.exceptions.Timeout as exc:
+                WATCHDOG.stalled('api', 'GraphQL query', 'timed out: %s' % exc)
+                WATCHDOG.pause(attempt)
+                continue
+            LOGGER.debug("POST %s %r ==> %d", self.url, variables, resp.status_code)
+            if resp.status_code in (403, 429) or (resp.ok and self._is_rate_limited(resp.json())):
+                self._sleep_until_reset(resp)
+                continue
+            resp.raise_for_status()
+            result = resp.json()
+            if result.get('errors'):
+                raise Exception("GraphQL query failed: %r" % result['errors'])
+            self._update_budget(result['data'].get('rateLimit'))
+            return result['data']
+        raise Exception("Failed too many times")
+
+    def _is_rate_limited(self, result):
+        return any(error.get('type') == 'RATE_LIMITED' for error in result.get('errors', []))
+
+    def _update_budget(self, rate_limit):
+        if not rate_limit:
+            return
+        with self.lock:
+            self.cost += rate_limit['cost']
+            self.remaining = rate_limit['remaining']
+            self.reset_at = parse_timestamp(rate_limit['resetAt'])
+
+    def _wait_for_budget(self):
+        with self.lock:
+            exhausted = self.remaining is not None and self.remaining < self.page_size
+            reset_at = self.reset_at
+        if exhausted and reset_at:
+            seconds = (reset_at - datetime.now(timezone.utc)).total_seconds() + 30
+            if seconds > 0.0:
+                LOGGER.warning("GraphQL budget exhausted, waiting for %d seconds...", seconds)
+                METRICS.add('rate_limit_wait_seconds', seconds)
+                time.sleep(seconds)
+            with self.lock:
+                self.remaining = None
+
+    def _sleep_until_reset(self, resp):
+        if resp.headers.get('Retry-After'):
+            seconds = int(resp.headers['Retry-After'])
+        elif resp.headers.get('X-RateLimit-Reset'):
+            seconds = int(resp.headers['X-RateLimit-Reset']) - time.time() + 30
+        else:
+            seconds = 60
+        LOGGER.warning("GraphQL rate limit exceeded, waiting for %d seconds...", seconds)
+        METRICS.add('rate_limit_wait_seconds', max(seconds, 0))
+        time.sleep(max(seconds, 0))
+
+    def get_issues(self, repo, args, since=None):
+        """Yield the issues of repo updated since `since`, in REST format."""
+        fields = GRAPHQL_ISSUE_FIELDS + self._connections(
+            comments=args.include_issue_comments, events=args.include_issue_events)
+        query = '''query($owner: String!, $name: String!, $first: Int!, $after: String, $since: DateTime) {
+            rateLimit { cost remaining resetAt }
+            repository(owner: $owner, name: $name) {
+                issues(first: $first, after: $after, filterBy: {since: $since},
+                       orderBy: {field: UPDATED_AT, direction: ASC}) {
+                    %s nodes { %s }
+                }
+            }
+        }''' % (GRAPHQL_PAGE_INFO, fields)
+        variables = {'owner': repo.owner.login, 'name': repo.name, 'first': self.page_size,
+                     'since': since.strftime('%Y-%m-%dT%H:%M:%SZ') if since else None}
+        for node in self._paginate(query, variables, ('repository', 'issues')):
+            self._complete_connections('Issue', node)
+            yield self._normalize_issue(node, repo)
+
+    def get_pulls(self, repo, args, since=None):
+        """Yield the pull requests of repo updated since `since`, in REST format."""
+        fields = GRAPHQL_PULL_FIELDS + self._connections(
+            reviews=args.include_pull_comments, commits=args.include_pull_commits)
+        query = '''query($owner: String!, $name: String!, $first: Int!, $after: String) {
+            rateLimit { cost remaining resetAt }
+            repository(owner: $owner, name: $name) {
+                pullRequests(first: $first, after: $after,
+                             orderBy: {field: UPDATED_AT, direction: DESC}) {
+                    %s nodes { %s }
+                }
+            }
+        }''' % (GRAPHQL_PAGE_INFO, fields)
+        variables = {'owner': repo.owner.login, 'name': repo.name, 'first': self.page_size}
+        for node in self._paginate(query, variables, ('repository', 'pullRequests')):
+            # pullRequests has no since filter, so stop at the first old one
+            if since and parse_timestamp(node['updatedAt']) < since:
+                return
+            self._complete_connections('PullRequest', node)
+            for review in node.get('reviews', {}).get('nodes', []):
+                self._complete_connections('PullRequestReview', review)
+            yield self._normalize_pull(node, repo)
+
+    def _connections(self, comments=False, events=False, reviews=False, commits=False):
+        fields = ''
+        if comments:
+            fields += self._connection('comments', GRAPHQL_COMMENT_FIELDS)
+        if events:
+            fields += self._connection('timelineItems', GRAPHQL_EVENT_FIELDS)
+        if reviews:
+            fields += self._connection('reviews', self._review_fields())
+        if commits:
+            fields += self._connection('commits', GRAPHQL_COMMIT_FIELDS)
+        return fields
+
+    def _review_fields(self):
+        return 'id ' + self._connection('comments', GRAPHQL_REVIEW_COMMENT_FIELDS,
+                                        first=self.REVIEW_COMMENTS_PAGE_SIZE)
+
+    def _connection(self, name, fields, after=None, first=100):
+        args = 'first: %d' % first
+        if name == 'timelineItems':
+            args += ', itemTypes: [%s]' % ', '.join(
+                re.sub(r'(?<!^)([A-Z])', r'_\1', t).upper() for t in GRAPHQL_EVENT_TYPES)
+        if after:
+            args += ', after: %s' % json.dumps(after)
+        return ' %s(%s) { %s nodes { %s } }' % (name, args, GRAPHQL_PAGE_INFO, fields)
+
+    def _paginate(self, query, variables, path):
+        variables = dict(variables, after=None)
+        while True:
+            data = self.query(query, variables)
+            for key in path:
+                data = data[key]
+            for node in data['nodes']:
+                yield node
+            if not data['pageInfo']['hasNextPage']:
+                return
+            variables['after'] = data['pageInfo']['endCursor']
+
+    def _complete_connections(self, type, node):
+        """Fetch the remaining pages of every nested connection of node."""
+        fields = {
+            'comments': GRAPHQL_REVIEW_COMMENT_FIELDS if type == 'PullRequestReview' else GRAPHQL_COMMENT_FIELDS,
+            'timelineItems': GRAPHQL_EVENT_FIELDS,
+            'reviews': self._review_fields(),
+            'commits': GRAPHQL_COMMIT_FIELDS,
+        }
+        for name, connection in node.items():
+            if not isinstance(connection, dict) or 'pageInfo' not in connection:
+                continue
+            page_info = connection['pageInfo']
+            while page_info['hasNextPage']:
+                query = '''query($id: ID!) {
+                    rateLimit { cost remaining resetAt }
+                    node(id: $id) { ... on %s { %s } }
+                }''' % (type, self._connection(name, fields[name], page_info['endCursor']))
+                page = self.query(query, {'id': node['id']})['node'][name]
+                connection['nodes'].extend(page['nodes'])
+                page_info = page['pageInfo']
+
+    def _normalize_issue(self, node, repo):
+        data = {
+            'id': node['databaseId'],
+            'node_id': node['id'],
+            'number': node['number'],
+            'title': node['title'],
+            'body': node['body'],
+            'state': node['state'].lower(),
+            'locked': node['locked'],
+            'created_at': node['createdAt'],
+            'updated_at': node['updatedAt'],
+            'closed_at': node['closedAt'],
+            'html_url': node['url'],
+            'url': '%s/issues/%d' % (repo.url, node['number']),
+            'user': _graphql_user(node['author']),
+            'labels': node['labels']['nodes'],
+            'assignees': node['assignees']['nodes'],
+            'assignee': node['assignees']['nodes'][0] if node['assignees']['nodes'] else None,
+            'milestone': node['milestone'],
+            'comments': node['commentCount']['totalCount'],
+        }
+        if 'comments' in node:
+            data['comment_data'] = [_graphql_comment(c) for c in node['comments']['nodes']]
+        if 'timelineItems' in node:
+            data['event_data'] = [_graphql_event(e) for e in node['timelineItems']['nodes']]
+        return data
+
+    def _normalize_pull(self, node, repo):
+        data = self._normalize_issue(node, repo)
+        data.update({
+            'url': '%s/pulls/%d' % (repo.url, node['number']),
+            'state': 'open' if node['state'] == 'OPEN' else 'closed',
+            'merged': node['merged'],
+            'merged_at': node['mergedAt'],
+            'merge_commit_sha': node['mergeCommit']['oid'] if node['mergeCommit'] else None,
+            'draft': node['isDraft'],
+            'additions': node['additions'],
+            'deletions': node['deletions'],
+            'changed_files': node['changedFiles'],
+            'commits': node['commitCount']['totalCount'],
+            'base': {'ref': node['baseRefName'], 'sha': node['baseRefOid']},
+            'head': {'ref': node['headRefName'], 'sha': node['headRefOid']},
+        })
+        data.pop('comment_data', None)
+        if 'reviews' in node:
+            data['comment_data'] = sorted(
+                (_graphql_comment(c) for review in node['reviews']['nodes']
+                 for c in review['comments']['nodes']),
+                key=lambda comment: comment['id'])
+        if 'commits' in node:
+            data['commit_data'] = [_graphql_commit(c['commit']) for c in node['commits']['nodes']]
+        return data
+
+def _graphql_user(user):
+    return {'login': user['login']} if user else None
+
+def _graphql_comment(node):
+    data = {
+        'id': node['databaseId'],
+        'node_id': node['id'],
+        'body': node['body'],
+        'created_at': node['createdAt'],
+        'updated_at': node['updatedAt'],
+        'html_url': node['url'],
+        'author_association': node['authorAssociation'],
+        'user': _graphql_user(node['author']),
+    }
+    if 'path' in node:
+        data.update({
+            'path': node['path'],
+            'diff_hunk': node['diffHunk'],
+            'position': node['position'],
+            'original_position': node['originalPosition'],
+            'commit_id': node['commit']['oid'] if node['commit'] else None,
+            'original_commit_id': node['originalCommit']['oid'] if node['originalCommit'] else None,
+            'in_reply_to_id': node['replyTo']['databaseId'] if node['replyTo'] else None,
+        })
+    return data
+
+def _graphql_event(node):
+    data = {
+        'node_id': node.get('id'),
+        'event': 'renamed' if node['__typename'] == 'RenamedTitleEvent' else node['__typename'][:-len('Event')].lower(),
+        'actor': _graphql_user(node.get('actor')),
+        'created_at': node.get('createdAt'),
+    }
+    if node.get('label'):
+        data['label'] = node['label']
+    if 'currentTitle' in node:
+        data['rename'] = {'from': node['previousTitle'], 'to': node['currentTitle']}
+    commit = node.get('commit') or node.get('closer')
+    if commit and commit.get('oid'):
+        data['commit_id'] = commit['oid']
+    return data
+
+def _graphql_commit(commit):
+    return {
+        'sha': commit['oid'],
+        'html_url': commit['url'],
+        'commit': {
+            'message': commit['message'],
+            'author': commit['author'],
+            'committer': commit['committer'],
+        },
+    }
 
 def init_parser():
     """Set up the argument parser."""
@@ -312,6 +1755,160 @@ def init_parser():
     parser.add_argument("-P", "--prefix", help="Add prefix to repository directory names", default="")
     parser.add_argument("-o", "--organization", help="Backup Organizational repositories", metavar="ORG")
     parser.add_argument("-A", "--account", help="Backup account data", action='store_true')
+    parser.add_argument("-j", "--jobs", help="Number of repositories to back up in parallel", type=int, default=1)
+    parser.add_argument("--git-jobs", help="Maximum number of concurrent git network operations (default: JOBS)", type=int, metavar="N")
+    parser.add_argument("--api-jobs", help="Maximum number of concurrent GitHub API calls (default: JOBS)", type=int, metavar="N")
+    parser.add_argument('--bulk-comments',
+                        action='store_true',
+                        help='fetch issue/pull request comments and events with one listing per repository instead of one per issue')
+    parser.add_argument('--graphql',
+                        action='store_true',
+                        help='fetch repository issues and pull requests in batches through the GraphQL API')
+    parser.add_argument('--graphql-page-size',
+                        type=int,
+                        default=50,
+                        metavar='N',
+                        help='number of issues or pull requests per GraphQL query (default: 50)')
+    parser.add_argument('--asset-jobs',
+                        type=int,
+                        default=4,
+                        metavar='N',
+                        help='number of release assets to download in parallel per repository (default: 4)')
+    parser.add_argument('--max-download-rate',
+                        type=parse_size,
+                        default=0,
+                        metavar='BYTES',
+                        help='limit the combined rate of asset downloads, in bytes per second (suffixes K, M and G are allowed)')
+    parser.add_argument('--metadata-store',
+                        choices=sorted(METADATA_STORES),
+                        default='files',
+                        help='how to save issues, pull requests, releases and account data: one JSON file each (default), '
+                             'one SQLite database, or zstd-compressed JSON lines per repository')
+    parser.add_argument('--export-metadata',
+                        metavar='DIR',
+                        help='export the jsonl or sqlite metadata store to DIR in the one-file-per-object layout and exit')
+    parser.add_argument('--dedupe-forks',
+                        action='store_true',
+                        help='keep the objects of forks in one shared store per fork network, borrowed through git alternates')
+    parser.add_argument('--maintenance',
+                        action='store_true',
+                        help='repack repositories and write their commit-graph after fetching when they need it')
+    parser.add_argument('--maintenance-budget',
+                        type=int,
+                        default=1800,
+                        metavar='SECONDS',
+                        help='total time to spend on maintenance per run (default: 1800)')
+    parser.add_argument('--maintenance-max-packs',
+                        type=int,
+                        default=10,
+                        metavar='N',
+                        help='repack repositories with more than N packs (default: 10)')
+    parser.add_argument('--maintenance-max-loose',
+                        type=int,
+                        default=2000,
+                        metavar='N',
+                        help='repack and prune repositories with more than N loose objects (default: 2000)')
+    parser.add_argument('--shard',
+                        type=parse_shard,
+                        metavar='INDEX/COUNT',
+                        help='only back up the repositories and gists assigned to shard INDEX of COUNT, and write a manifest of them')
+    parser.add_argument('--verify-shards',
+                        metavar='DIR',
+                        help='check that the shard manifests collected in DIR cover every repository and gist, and exit')
+    parser.add_argument('--events',
+                        action='store_true',
+                        help="only back up the repositories with new events in the account's event feed since the last run")
+    parser.add_argument('--full-sweep-interval',
+                        type=float,
+                        default=24,
+                        metavar='HOURS',
+                        help='with --events, still back up everything when the last full sweep is older than HOURS (default: 24)')
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help='keep running and back up every repository again when it is due, see "Run as a daemon"')
+    parser.add_argument('--daemon-socket',
+                        metavar='PATH',
+                        help='with --daemon, the Unix socket to read commands from (default: BACKUPDIR/daemon.sock)')
+    parser.add_argument('--refresh-interval',
+                        type=int,
+                        default=3600,
+                        metavar='SECONDS',
+                        help='with --daemon, list the repositories again every SECONDS (default: 3600)')
+    parser.add_argument('--daemon-min-interval',
+                        type=int,
+                        default=300,
+                        metavar='SECONDS',
+                        help='with --daemon, back up a repository at most every SECONDS (default: 300)')
+    parser.add_argument('--daemon-max-interval',
+                        type=int,
+                        default=86400,
+                        metavar='SECONDS',
+                        help='with --daemon, back up a repository at least every SECONDS (default: 86400)')
+    parser.add_argument('--daemon-reserve',
+                        type=int,
+                        default=500,
+                        metavar='N',
+                        help='with --daemon, only start scheduled backups while a token has more than N API calls left (default: 500)')
+    parser.add_argument('--api-url',
+                        default='https://api.github.com',
+                        metavar='URL',
+                        help='base URL of the GitHub API, e.g. https://HOST/api/v3 for GitHub Enterprise Server (default: https://api.github.com)')
+    parser.add_argument('--report',
+                        metavar='FILE',
+                        help='write a JSON report of the run with per-phase and per-repository timings to FILE')
+    parser.add_argument('--prometheus-file',
+                        metavar='FILE',
+                        help='write the metrics of the run to FILE for the node_exporter textfile collector')
+    parser.add_argument('--profile',
+                        metavar='FILE',
+                        help='profile the backups with cProfile and dump the stats to FILE')
+    parser.add_argument('--plan',
+                        metavar='FILE',
+                        help="don't back up anything, estimate the work and API requests a backup would take and write the plan to FILE")
+    parser.add_argument('--execute-plan',
+                        metavar='FILE',
+                        help='only back up the repositories and gists that the plan in FILE found work for')
+    parser.add_argument('--negative-cache-ttl',
+                        type=float,
+                        default=168,
+                        metavar='HOURS',
+                        help="how long to trust that a repository has no wiki, issues or commits before "
+                             "checking again, unless its metadata changes; 0 to always check (default: 168)")
+    parser.add_argument('--git-timeout',
+                        type=int,
+                        default=3 * 3600,
+                        metavar='SECONDS',
+                        help='kill a git clone or fetch that runs for longer than this, 0 for no limit (default: 10800)')
+    parser.add_argument('--http-timeout',
+                        type=int,
+                        default=60,
+                        metavar='SECONDS',
+                        help='give up on an HTTP connection that sends nothing for this long, 0 for no limit (default: 60)')
+    parser.add_argument('--min-transfer-rate',
+                        type=parse_size,
+                        default=1024,
+                        metavar='BYTES',
+                        help='abort git transfers and downloads slower than this many bytes per second over the stall window, '
+                             '0 to allow any rate (default: 1K)')
+    parser.add_argument('--stall-window',
+                        type=int,
+                        default=120,
+                        metavar='SECONDS',
+                        help='time over which the transfer rate is measured (default: 120)')
+    parser.add_argument('--timeout-retries',
+                        type=int,
+                        default=2,
+                        metavar='N',
+                        help='times to retry a git command or HTTP request that timed out or stalled (default: 2)')
+    parser.add_argument('--dedupe-assets',
+                        action='store_true',
+                        help='keep one copy of every release asset in BACKUPDIR/assets, linked from the release directories')
+    parser.add_argument('--gc-assets',
+                        action='store_true',
+                        help='remove the assets in BACKUPDIR/assets that no saved release refers to anymore, and exit')
+    parser.add_argument('--full-resync',
+                        action='store_true',
+                        help='ignore the saved sync state: fetch every repository and download all issues and pull requests again')
     parser.add_argument('--all',
                         action='store_true',
                         dest='include_everything',
@@ -384,14 +1981,710 @@ def init_parser():
 
     return parser
 
-def fetch_url(url, outfile):
-    headers = {
-        "User-Agent": "PyGithub/Python"
-    }
-    with open(outfile, 'w') as f:
-        resp = requests.get(url, headers=headers)
-        LOGGER.debug("GET %s %r ==> %d %r", url, headers, resp.status_code, resp.headers)
-        f.write(resp.content.decode(resp.encoding or 'utf-8'))
+class BandwidthLimiter(object):
+    """Token bucket shared by all downloads to cap their combined rate."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = rate
+        self.last = time.time()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+DOWNLOAD_LIMITER = BandwidthLimiter(0)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+class Stalled(Exception):
+    """A git command or HTTP transfer ran out of time or stopped making progress."""
+
+# What git says when curl gives up on a slow transfer (http.lowSpeedLimit) or a connection
+GIT_STALL_MESSAGE = re.compile(r'Operation too slow|timed out', re.IGNORECASE)
+
+# What git says when there is no repository at the URL
+GIT_NOT_FOUND = re.compile(r'not found|does not appear to be a git repository', re.IGNORECASE)
+
+# The progress meters git writes with --progress, and the one with the bytes received
+GIT_PROGRESS = re.compile(r'^(remote: )?[A-Z][\w ]+:\s+\d+% \(\d+/\d+\)')
+GIT_RECEIVED = re.compile(r'^Receiving objects:.*?, ([0-9.]+) (bytes|KiB|MiB|GiB)')
+GIT_UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+class Watchdog(object):
+    """Time limits for network git commands and HTTP transfers.
+
+    git_timeout caps the wall-clock time of a git clone or fetch, and
+    http_timeout the wait for a connection or the next bytes of a response.
+    Transfers moving less than min_rate bytes per second over window
+    seconds count as stalled, git's going by its progress meters. Timed
+    out operations are killed, recorded in METRICS and retried up to
+    retries times, after a growing pause.
+    """
+
+    def __init__(self, git_timeout=0, http_timeout=None, min_rate=0, window=60, retries=0):
+        self.git_timeout = git_timeout
+        self.http_timeout = http_timeout
+        self.min_rate = min_rate
+        self.window = window
+        self.retries = retries
+
+    def git_config(self):
+        """Return the git options that abort HTTP transfers slower than min_rate.
+
+        This also catches a stalled connection while the server is still
+        preparing the pack, when there are no bytes to count yet.
+        """
+        if not self.min_rate:
+            return []
+        return ['-c', 'http.lowSpeedLimit=%d' % self.min_rate, '-c', 'http.lowSpeedTime=%d' % self.window]
+
+    def stalled(self, kind, what, reason):
+        """Record a timeout and return the exception to raise for it."""
+        LOGGER.warning("%s %s", what, reason)
+        METRICS.timeout(kind, what, reason)
+        return Stalled("%s %s" % (what, reason))
+
+    def pause(self, attempt):
+        seconds = min(5 * 2 ** attempt, 300)
+        LOGGER.info("Retrying in %d seconds", seconds)
+        time.sleep(seconds)
+
+    @contextlib.contextmanager
+    def watch(self, kind, what, kill, timeout=0, measure=False):
+        """Call kill() and raise Stalled if the block runs for more than timeout seconds or,
+        if measure is set, transfers less than min_rate bytes per second.
+
+        The block reports its progress by calling the function it is given
+        with the number of bytes it received, or with None for progress of
+        another kind, which keeps the transfer alive for the current window.
+        """
+        received = [0]
+        busy = [False]
+        reason = []
+        done = threading.Event()
+        measure = measure and self.min_rate
+
+        def progress(nbytes):
+            if nbytes is None:
+                busy[0] = True
+            else:
+                received[0] += nbytes
+
+        def monitor():
+            start = window_start = time.time()
+            window_bytes = 0
+            while True:
+                wait = self.window if measure else timeout
+                if timeout:
+                    wait = min(wait, start + timeout - time.time())
+                if done.wait(max(wait, 0)):
+                    return
+                now = time.time()
+                if timeout and now - start >= timeout:
+                    reason.append('ran for more than %d seconds' % timeout)
+                elif measure and now - window_start >= self.window:
+                    if received[0] - window_bytes < self.min_rate * (now - window_start) and not busy[0]:
+                        reason.append('transferred less than %d bytes per second for %d seconds'
+                                      % (self.min_rate, now - window_start))
+                    window_start, window_bytes, busy[0] = now, received[0], False
+                if reason:
+                    kill()
+                    return
+
+        if not timeout and not measure:
+            yield progress
+            return
+        thread = threading.Thread(target=monitor, daemon=True)
+        thread.start()
+        try:
+            yield progress
+        except Exception:
+            # Whatever kill() made the block fail with
+            if not reason:
+                raise
+        finally:
+            done.set()
+            thread.join()
+        if reason:
+            raise self.stalled(kind, what, reason[0])
+
+WATCHDOG = Watchdog()
+
+def abort_response(resp):
+    """Break off a response that another thread is reading."""
+    # Closing the response would wait for the read to finish, while
+    # shutting its socket down makes the read fail right away
+    try:
+        with socket.fromfd(resp.raw.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, ValueError):
+        pass
+
+class HttpCache(object):
+    """ETag and Last-Modified values of the URLs fetched by earlier runs.
+
+    GitHub doesn't count 304 Not Modified responses against the rate limit,
+    so revalidating with these is almost free.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = load_state(path) if path else {}
+
+    def headers(self, url):
+        """Return the headers that make a request for url conditional."""
+        with self.lock:
+            entry = self.entries.get(url, {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def next_url(self, url, resp):
+        """Return the next page after url, which a 304 response doesn't tell."""
+        if resp.status_code == 304:
+            with self.lock:
+                return self.entries.get(url, {}).get('next')
+        return resp.links.get('next', {}).get('url')
+
+    def store(self, url, resp):
+        if resp.status_code == 304:
+            return
+        entry = {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'next': resp.links.get('next', {}).get('url'),
+        }
+        with self.lock:
+            if entry['etag'] or entry['last_modified']:
+                self.entries[url] = entry
+            else:
+                self.entries.pop(url, None)
+
+    def save(self):
+        if self.path:
+            with self.lock:
+                save_state(self.path, self.entries)
+
+class AssetStore(object):
+    """Keep one copy of every release asset, in assets/sha256/ by content digest.
+
+    The files under releases/<tag>/ are hardlinks to (or reflinks or, failing
+    both, copies of) these blobs. index.json maps the id, size and updated_at
+    of every asset downloaded so far to its digest, so an asset is never
+    downloaded twice, and neither is one whose digest GitHub reports and
+    that is already stored.
+    """
+
+    def __init__(self, backupdir):
+        self.dir = os.path.join(backupdir, 'assets')
+        self.index_file = os.path.join(self.dir, 'index.json')
+        self.lock = threading.Lock()
+        self.index = load_state(self.index_file)
+
+    @staticmethod
+    def key(asset_data):
+        return '%s:%s:%s' % (asset_data['id'], asset_data['size'], asset_data.get('updated_at'))
+
+    def blob_path(self, digest):
+        return os.path.join(self.dir, 'sha256', digest[:2], digest)
+
+    def lookup(self, asset_data):
+        """Return the stored blob of an asset, or None."""
+        with self.lock:
+            digest = self.index.get(self.key(asset_data))
+        # Newer API versions report the digest of every asset
+        if not digest and (asset_data.get('digest') or '').startswith('sha256:'):
+            digest = asset_data['digest'][len('sha256:'):]
+        if digest and os.path.exists(self.blob_path(digest)):
+            with self.lock:
+                self.index[self.key(asset_data)] = digest
+            return self.blob_path(digest)
+        return None
+
+    def add(self, asset_data, path):
+        """Store the freshly downloaded path as the blob of an asset, and link path to it."""
+        digest = file_digest(path).hex()
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            mkdir_p(os.path.dirname(blob))
+            link_file(path, blob)
+        else:
+            link_file(blob, path)
+        with self.lock:
+            self.index[self.key(asset_data)] = digest
+
+    def save(self):
+        with self.lock:
+            save_state(self.index_file, self.index)
+
+    def gc(self, store, backupdir):
+        """Remove the blobs of assets that no saved release refers to anymore."""
+        referenced = set()
+        for release in stored_releases(store, backupdir):
+            for asset_data in release.get('assets') or []:
+                referenced.add(self.key(asset_data))
+        with self.lock:
+            self.index = dict((key, digest) for key, digest in self.index.items() if key in referenced)
+            digests = set(self.index.values())
+        removed, freed = 0, 0
+        for blob in glob.glob(os.path.join(self.dir, 'sha256', '*', '*')):
+            if os.path.basename(blob) in digests:
+                continue
+            stat = os.stat(blob)
+            # A blob still linked from a release directory takes no space of its own
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+            os.remove(blob)
+            removed += 1
+        self.save()
+        LOGGER.info("Removed %d unreferenced asset blobs, freeing %.1f MB", removed, freed / 1e6)
+
+ASSET_STORE = None
+
+def stored_releases(store, backupdir):
+    """Yield every release saved in store."""
+    if hasattr(store, 'items'):
+        documents = (data for path, data in store.items()
+                     if path.split(os.sep)[0] == 'repositories' and path.split(os.sep)[2:3] == ['releases'])
+    else:
+        documents = (load_state(path) for path in
+                     glob.glob(os.path.join(backupdir, 'repositories', '*', 'releases', '**', '*.json'),
+                               recursive=True))
+    for data in documents:
+        # Assets that happen to be JSON files live next to the releases
+        if isinstance(data, dict) and 'tag_name' in data:
+            yield data
+
+# ioctl to share the extents of a file on btrfs, XFS and others, from linux/fs.h
+FICLONE = 0x40049409
+
+def link_file(src, dst):
+    """Make dst a hardlink to src, or a reflink or a copy where that isn't possible."""
+    tmp_path = '%s.%d-%d.tmp' % (dst, os.getpid(), threading.get_ident())
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        try:
+            import fcntl
+            with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (ImportError, OSError):
+            shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+# One keep-alive connection pool for all HTTP requests made outside PyGithub
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "PyGithub/Python"
+HTTP_CACHE = HttpCache()
+
+class RequesterAuth(requests.auth.AuthBase):
+    """Authenticate a request with the credentials of a PyGithub requester."""
+
+    def __init__(self, requester):
+        self.auth = requester.auth
+
+    def __call__(self, request):
+        if self.auth is not None:
+            request.headers['Authorization'] = '%s %s' % (self.auth.token_type, self.auth.token)
+        return request
+
+def is_rate_limited(resp):
+    """Check whether resp is GitHub refusing a request over a primary or secondary rate limit."""
+    if resp.status_code == 429:
+        return True
+    return resp.status_code == 403 and (resp.headers.get('X-RateLimit-Remaining') == '0'
+                                        or 'Retry-After' in resp.headers
+                                        or 'rate limit' in resp.text.lower())
+
+def conditional_get(url, conditional=True, owner=None, **kwargs):
+    """GET url with the validators in HTTP_CACHE.
+
+    A 304 response means the content is unchanged. The caller stores the
+    new validators with HTTP_CACHE.store() once it has saved the content.
+    API requests pass the PyGithub object they are made for as owner: they
+    are then paced, sent and backed off from rate limits with its token,
+    like the calls rate_limited_retry wraps.
+    """
+    headers = HTTP_CACHE.headers(url) if conditional else {}
+    headers.update(kwargs.pop('headers', {}))
+    if owner is None:
+        return _session_get(url, headers, **kwargs)
+    budget = SCHEDULER.budget_for(owner, 'core') or RateLimitBudget()
+    for attempt in range(3):
+        SCHEDULER.wait(budget)
+        with API_SLOTS:
+            resp = _session_get(url, headers, auth=RequesterAuth(owner.requester), **kwargs)
+        SCHEDULER.update_from_headers(budget, resp.headers)
+        if not is_rate_limited(resp):
+            break
+        SCHEDULER.backoff(budget, resp.headers)
+    return resp
+
+def _session_get(url, headers, **kwargs):
+    for attempt in range(WATCHDOG.retries + 1):
+        try:
+            resp = SESSION.get(url, headers=headers, timeout=WATCHDOG.http_timeout, **kwargs)
+            break
+        except requests.exceptions.Timeout as exc:
+            stalled = WATCHDOG.stalled('http', 'GET %s' % url, 'timed out: %s' % exc)
+            if attempt == WATCHDOG.retries:
+                raise stalled
+            WATCHDOG.pause(attempt)
+    LOGGER.debug("GET %s %r ==> %d %r", url, headers, resp.status_code, resp.headers)
+    return resp
+
+def fetch_url(url, outfile, size=None):
+    """Stream url into outfile.
+
+    The data is written to outfile.part first and renamed once complete, so
+    outfile is never left half-written. An existing outfile.part from an
+    interrupted download is resumed with a Range request, guarded by If-Range
+    so that a file replaced in the meantime is downloaded whole, and an
+    existing outfile is only downloaded again if the server says it has changed.
+    Stalled and broken downloads are resumed the same way, after a pause.
+    """
+    for attempt in range(WATCHDOG.retries + 1):
+        try:
+            return _fetch_url(url, outfile, size)
+        except Stalled:
+            if attempt == WATCHDOG.retries:
+                raise
+        except requests.exceptions.ConnectionError as exc:
+            # requests wraps a read timeout in the middle of the body this way
+            if exc.args and isinstance(exc.args[0], requests.packages.urllib3.exceptions.ReadTimeoutError):
+                WATCHDOG.stalled('http', 'Download of %s' % url, 'timed out: %s' % exc.args[0])
+            else:
+                LOGGER.warning("Download of %s failed: %s", url, exc)
+            if attempt == WATCHDOG.retries:
+                raise
+        WATCHDOG.pause(attempt)
+
+def _fetch_url(url, outfile, size):
+    headers = {}
+    part_file = outfile + '.part'
+    # The validator of the response outfile.part was started from
+    validator_file = part_file + '-validator'
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    validator = None
+    if offset and os.path.exists(validator_file):
+        with open(validator_file) as f:
+            validator = f.read().strip()
+    if offset and validator:
+        # If the file changed since, the server sends all of the new one
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = validator
+    else:
+        # Nothing tells whether the part is of the file that is there now
+        offset = 0
+    conditional = not offset and os.path.exists(outfile)
+
+    with conditional_get(url, conditional, headers=headers, stream=True) as resp:
+        if resp.status_code == 304:
+            LOGGER.debug("%s is unchanged", url)
+            return
+        if resp.status_code == 416 and offset == size:
+            # The previous attempt got everything but the rename
+            pass
+        else:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                offset = 0
+                _save_validator(validator_file, resp)
+            with open(part_file, 'ab' if offset else 'wb') as f, \
+                    WATCHDOG.watch('http', 'Download of %s' % url, lambda: abort_response(resp), measure=True) as progress:
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    DOWNLOAD_LIMITER.consume(len(chunk))
+                    METRICS.add('downloaded_bytes', len(chunk))
+                    progress(len(chunk))
+                    f.write(chunk)
+
+    if size is not None and os.path.getsize(part_file) != size:
+        actual = os.path.getsize(part_file)
+        if actual > size:
+            os.remove(part_file)
+        raise IOError("Downloaded %d bytes of %s, expected %d" % (actual, url, size))
+    os.replace(part_file, outfile)
+    if os.path.exists(validator_file):
+        os.remove(validator_file)
+    if not offset:
+        HTTP_CACHE.store(url, resp)
+
+def _save_validator(path, resp):
+    """Save the validator of resp that If-Range accepts, a strong ETag or else Last-Modified."""
+    etag = resp.headers.get('ETag')
+    validator = etag if etag and not etag.startswith('W/') else resp.headers.get('Last-Modified')
+    if validator:
+        with open(path, 'w') as f:
+            f.write(validator + '\n')
+    elif os.path.exists(path):
+        os.remove(path)
+
+def fetch_list(owner, url, outfile):
+    """Save every page of a list endpoint into outfile as one JSON array.
+
+    Pages are written out as they arrive, so memory use doesn't grow with
+    the length of the list. If outfile exists and none of the pages changed
+    since it was written, it is left alone.
+    """
+    # Drop URI templates like {/other_user}
+    url = re.sub(r'\{[^}]*\}', '', url)
+    url += ('&' if '?' in url else '?') + 'per_page=100'
+
+    conditional = os.path.exists(outfile)
+    unchanged = []
+    responses = []
+    count = 0
+
+    def write_page(resp, count):
+        resp.raise_for_status()
+        for item in resp.json():
+            f.write(',\n' if count else '\n')
+            json_dump(item, f)
+            count += 1
+        return count
+
+    part_file = outfile + '.part'
+    with codecs.open(part_file, 'w', encoding='utf-8') as f:
+        f.write('[')
+        while url:
+            resp = conditional_get(url, conditional, owner)
+            if resp.status_code == 304:
+                unchanged.append(url)
+                url = HTTP_CACHE.next_url(url, resp)
+                continue
+            if conditional:
+                # This page changed, so the unchanged ones before it are
+                # needed after all
+                conditional = False
+                for page_url in unchanged:
+                    page = conditional_get(page_url, False, owner)
+                    count = write_page(page, count)
+                    responses.append((page_url, page))
+            count = write_page(resp, count)
+            responses.append((url, resp))
+            url = HTTP_CACHE.next_url(url, resp)
+        f.write('\n]\n')
+
+    if conditional:
+        LOGGER.debug("%s is unchanged", outfile)
+        os.remove(part_file)
+        return
+    JSON_WRITER.replace(part_file, outfile)
+    for url, resp in responses:
+        HTTP_CACHE.store(url, resp)
+
+class FileStore(object):
+    """Save metadata as one JSON file per object."""
+
+    def put(self, path, data):
+        write_json(path, data)
+
+    def get(self, path):
+        return load_state(path)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteStore(object):
+    """Save metadata into one SQLite database in the backup directory.
+
+    Objects are upserted under the path FileStore would have saved them at,
+    relative to the backup directory, so they can be exported to that
+    layout again.
+    """
+
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, backupdir):
+        self.backupdir = backupdir
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(os.path.join(backupdir, 'metadata.sqlite'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS objects (
+                               path TEXT PRIMARY KEY,
+                               scope TEXT NOT NULL,
+                               kind TEXT NOT NULL,
+                               data TEXT NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS objects_scope_kind ON objects (scope, kind)')
+
+    def put(self, path, data):
+        path = os.path.relpath(path, self.backupdir)
+        scope, kind = metadata_scope(path)
+        with self.lock:
+            self.db.execute('''INSERT INTO objects (path, scope, kind, data) VALUES (?, ?, ?, ?)
+                               ON CONFLICT (path) DO UPDATE SET data = excluded.data''',
+                            (path, scope, kind, json.dumps(data, ensure_ascii=False, sort_keys=True)))
+            self.pending += 1
+            if self.pending >= self.COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+
+    def get(self, path):
+        path = os.path.relpath(path, self.backupdir)
+        with self.lock:
+            row = self.db.execute('SELECT data FROM objects WHERE path = ?', (path,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def items(self):
+        with self.lock:
+            rows = self.db.execute('SELECT path, data FROM objects ORDER BY path').fetchall()
+        for path, data in rows:
+            yield path, json.loads(data)
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+class JSONLStore(object):
+    """Save metadata as zstd-compressed JSON lines, in segments per repository.
+
+    Every run appends a new segment to metadata/ in the repository's (or the
+    account's) directory; later records for a path replace earlier ones.
+    Once there are more than MAX_SEGMENTS, they are compacted into one.
+    """
+
+    MAX_SEGMENTS = 8
+
+    def __init__(self, backupdir):
+        self.backupdir = backupdir
+        self.lock = threading.Lock()
+        self.writers = {}
+        self.indexes = {}
+
+    def _segment_dir(self, scope):
+        return os.path.join(self.backupdir, scope, 'metadata')
+
+    def _segments(self, scope):
+        dir = self._segment_dir(scope)
+        if not os.path.isdir(dir):
+            return []
+        return sorted(os.path.join(dir, name) for name in os.listdir(dir) if name.endswith('.jsonl.zst'))
+
+    def _read(self, scope):
+        """Return the latest record for each path in the segments of scope."""
+        records = {}
+        for segment in self._segments(scope):
+            with open(segment, 'rb') as f:
+                reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+                for line in io.TextIOWrapper(reader, encoding='utf-8'):
+                    record = json.loads(line)
+                    records[record['path']] = record['data']
+        return records
+
+    def put(self, path, data):
+        path = os.path.relpath(path, self.backupdir)
+        scope = metadata_scope(path)[0]
+        line = json.dumps({'path': path, 'data': data}, ensure_ascii=False, sort_keys=True) + '\n'
+        with self.lock:
+            if scope not in self.writers:
+                # get() can't read the records of an open segment, so the index
+                # has to be there to take them from the start
+                if scope not in self.indexes:
+                    self.indexes[scope] = self._read(scope)
+                dir = self._segment_dir(scope)
+                if not os.access(dir, os.F_OK):
+                    mkdir_p(dir)
+                segment = os.path.join(dir, '%020d-%d.jsonl.zst' % (time.time_ns(), os.getpid()))
+                f = open(segment, 'wb')
+                self.writers[scope] = (f, zstandard.ZstdCompressor().stream_writer(f))
+            self.writers[scope][1].write(line.encode('utf-8'))
+            self.indexes[scope][path] = data
+
+    def get(self, path):
+        path = os.path.relpath(path, self.backupdir)
+        scope = metadata_scope(path)[0]
+        with self.lock:
+            if scope not in self.indexes:
+                self.indexes[scope] = self._read(scope)
+            return self.indexes[scope].get(path, {})
+
+    def items(self):
+        scopes = set()
+        for dir, dirs, files in os.walk(self.backupdir):
+            # Don't descend into clones and other file trees
+            dirs[:] = [d for d in dirs if d not in ('repository', 'wiki', 'releases', 'issues', 'pull-requests')]
+            if os.path.basename(dir) == 'metadata':
+                scopes.add(os.path.relpath(os.path.dirname(dir), self.backupdir))
+        for scope in sorted(scopes):
+            for path, data in sorted(self._read(scope).items()):
+                yield path, data
+
+    def close(self):
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            for scope, (f, writer) in self.writers.items():
+                writer.close()
+                segments = self._segments(scope)
+                if len(segments) > self.MAX_SEGMENTS:
+                    self._compact(scope, segments)
+            self.writers = {}
+            # A long-lived store (--daemon) reads the segments again when it
+            # needs them, instead of keeping every repository's records
+            self.indexes = {}
+
+    def _compact(self, scope, segments):
+        records = self._read(scope)
+        compacted = segments[-1] + '.compacted'
+        with open(compacted, 'wb') as f:
+            with zstandard.ZstdCompressor().stream_writer(f) as writer:
+                for path, data in sorted(records.items()):
+                    line = json.dumps({'path': path, 'data': data}, ensure_ascii=False, sort_keys=True)
+                    writer.write((line + '\n').encode('utf-8'))
+        for segment in segments:
+            os.remove(segment)
+        os.rename(compacted, segments[-1])
+
+METADATA_STORES = {
+    'files': lambda backupdir: FileStore(),
+    'sqlite': SQLiteStore,
+    'jsonl': JSONLStore,
+}
+
+STORE = FileStore()
+
+def metadata_scope(path):
+    """Split a path relative to the backup directory into the repository (or
+    account) it belongs to and the kind of object it is."""
+    parts = path.split(os.sep)
+    if parts[0] == 'repositories' and len(parts) > 2:
+        return os.path.join(*parts[:2]), parts[2] if len(parts) > 3 else ''
+    if parts[0] == 'account' and len(parts) > 2:
+        return parts[0], parts[1]
+    return parts[0], ''
+
+def export_metadata(store, outdir):
+    """Write everything in store to outdir in the one-file-per-object layout."""
+    files = FileStore()
+    count = 0
+    for path, data in store.items():
+        files.put(os.path.join(outdir, path), data)
+        count += 1
+    LOGGER.info("Exported %d objects to %s", count, outdir)
 
 def process_account(gh, account, args):
     LOGGER.info("Processing account: %s", get_account_login(account))
@@ -401,60 +2694,61 @@ def process_account(gh, account, args):
         mkdir_p(dir)
 
     account_file = os.path.join(dir, 'account.json')
-    with codecs.open(account_file, 'w', encoding='utf-8') as f:
-        json_dump(get_account_raw_data(account), f)
+    STORE.put(account_file, get_account_raw_data(account))
 
     if IS_AUTHORIZED:
         emails_file = os.path.join(dir, 'emails.json')
-        with codecs.open(emails_file, 'w', encoding='utf-8') as f:
-            json_dump(list(get_account_emails(account)), f)
+        STORE.put(emails_file, list(get_account_emails(account)))
 
     if args.include_starred:
         LOGGER.info("    Getting starred repository list")
-        fetch_url(get_account_starred_urls(account), os.path.join(dir, 'starred.json'))
+        fetch_list(account, get_account_starred_urls(account), os.path.join(dir, 'starred.json'))
 
     if args.include_watched:
         LOGGER.info("    Getting watched repository list")
-        fetch_url(get_account_subscriptions_url(account), os.path.join(dir, 'watched.json'))
+        fetch_list(account, get_account_subscriptions_url(account), os.path.join(dir, 'watched.json'))
 
     if args.include_followers:
         LOGGER.info("    Getting followers repository list")
-        fetch_url(get_account_followers_url(account), os.path.join(dir, 'followers.json'))
+        fetch_list(account, get_account_followers_url(account), os.path.join(dir, 'followers.json'))
 
     if args.include_following:
         LOGGER.info("    Getting following repository list")
-        fetch_url(get_account_following_url(account), os.path.join(dir, 'following.json'))
+        fetch_list(account, get_account_following_url(account), os.path.join(dir, 'following.json'))
 
     if args.include_keys:
         LOGGER.info("    Getting keys")
         for key in get_account_keys(account):
-            key_dir = os.path.join(dir, 'keys')
-            if not os.access(key_dir, os.F_OK):
-                mkdir_p(key_dir)
-            key_file = os.path.join(key_dir, key.title+'.json')
-            with codecs.open(key_file, 'w', encoding='utf-8') as f:
-                json_dump(get_key_raw_data(key), f)
-
-    filters = ('assigned', 'created')
+            key_file = os.path.join(dir, 'keys', key.title+'.json')
+            STORE.put(key_file, get_key_raw_data(key))
 
     if args.include_issues:
         LOGGER.info("    Getting issues for user %s", get_account_login(account))
-        issues = []
-        for filter in filters:
-            _issues = get_search_issues(gh, get_account_login(account), 'issue')
-            issues = itertools.chain(issues, _issues)
-
+        issues = get_search_issues(gh, get_account_login(account), 'issue')
         RepositoryBackup._backup_issues(issues, args, dir)
 
     if args.include_pulls:
         LOGGER.info("    Getting pull requests for user %s", get_account_login(account))
-        issues = []
-        for filter in filters:
-            _issues = get_search_issues(gh, get_account_login(account), 'pr')
-            issues = itertools.chain(issues, _issues)
-
-        RepositoryBackup._backup_pulls(issues, args, dir)
-
+        pulls = get_search_issues(gh, get_account_login(account), 'pr')
+        RepositoryBackup._backup_pulls(pulls, args, dir)
+
+
+# The repository metadata that a change of may bring back what an earlier
+# backup found missing: a wiki, enabled issues, or any commits. Releases
+# aren't in here: publishing one needn't change pushed_at, and the 304 to
+# the conditional release listing costs nothing anyway
+MISSING_KEYS = {
+    'wiki': 'has_wiki',
+    'issues': 'has_issues',
+    'empty': 'pushed_at',
+}
+
+# The options that decide what an incremental sync of issues or pull
+# requests saves, besides the metadata store and the API used
+SYNC_OPTIONS = {
+    'issues': ('include_issue_comments', 'include_issue_events'),
+    'pulls': ('include_pull_comments', 'include_pull_commits'),
+}
 
 class RepositoryBackup(object):
     def __init__(self, repo, args):
@@ -462,6 +2756,7 @@ class RepositoryBackup(object):
         self.args = args
 
         self.is_gist = isinstance(repo, github.Gist.Gist)
+        self.name = repo.id if self.is_gist else repo.full_name
 
         if self.is_gist:
             dir = os.path.join(args.backupdir, 'gists', repo.id)
@@ -469,6 +2764,12 @@ class RepositoryBackup(object):
             dir = os.path.join(args.backupdir, 'repositories', args.prefix + repo.name + args.suffix, 'repository')
         self.dir = dir
 
+        if self.is_gist:
+            self.state_file = os.path.join(os.path.dirname(dir), repo.id + '.state.json')
+        else:
+            self.state_file = os.path.join(os.path.dirname(dir), 'state.json')
+        self.state = load_state(self.state_file)
+
         if self.is_gist:
             url = repo.git_pull_url
         elif args.type == 'http' or not IS_AUTHORIZED:
@@ -485,6 +2786,10 @@ class RepositoryBackup(object):
             self.wiki_dir = os.path.join(args.backupdir, 'repositories', args.prefix + repo.name + args.suffix, 'wiki')
 
     def backup(self):
+        # Do all API calls for this repository with the token that has the most headroom
+        client = SCHEDULER.pick()
+        self.repo = client.create_from_raw_data(type(self.repo), self.repo._rawData)
+
         if self.is_gist:
             LOGGER.info("Processing gist: %s", self.repo.id)
         else:
@@ -493,148 +2798,878 @@ class RepositoryBackup(object):
         config = os.path.join(self.dir, "config" if self.args.mirror else ".git/config")
         if not os.access(os.path.dirname(self.dir), os.F_OK):
             mkdir_p(os.path.dirname(self.dir))
+        dedupe = self.args.dedupe_forks and not self.is_gist and self.repo.fork
         if not os.access(config, os.F_OK):
             LOGGER.info("Repo doesn't exist, lets clone it")
-            self.clone_repo(self.url, self.dir)
+            with METRICS.phase('clone', self.name):
+                network = self._fetch_into_network() if dedupe else None
+                if self.clone_repo(self.url, self.dir, network):
+                    raise GitError("git clone of %s failed" % self.url)
+        elif self._is_unchanged():
+            LOGGER.info("Repo hasn't been pushed to since the last backup, skipping update")
+            if self.repo._rawData.get('updated_at') != self.state.get('updated_at'):
+                self.update_repo(self.dir, fetch=False)
         else:
             LOGGER.info("Repo already exists, let's try to update it instead")
-            self.update_repo(self.dir)
+            with METRICS.phase('fetch', self.name):
+                if dedupe:
+                    self._use_alternates(self._fetch_into_network())
+                if self.update_repo(self.dir):
+                    raise GitError("git update of %s failed" % self.dir)
+        if self.args.maintenance:
+            with METRICS.phase('maintenance', self.name):
+                self._maintain()
+        self._save_push_state()
+        if not self.is_gist:
+            # Without commits there can't be any releases or pull requests either
+            self._set_missing('empty', self.state['refs'] == _fingerprint([]))
 
         if self.wiki_url:
-            config = os.path.join(self.wiki_dir, "config" if self.args.mirror else ".git/config")
-            if not os.access(os.path.dirname(self.wiki_dir), os.F_OK):
-                mkdir_p(os.path.dirname(self.wiki_dir))
-            if not os.access(config, os.F_OK):
-                LOGGER.info("Wiki repo doesn't exist, lets clone it")
-                self.clone_repo(self.wiki_url, self.wiki_dir)
-            else:
-                LOGGER.info("Wiki repo already exists, let's try to update it instead")
-                self.update_repo(self.wiki_dir)
+            with METRICS.phase('wiki', self.name):
+                self._backup_wiki()
 
         if self.is_gist:
             # Save extra gist info
             gist_file = os.path.join(os.path.dirname(self.dir), self.repo.id+'.json')
-            with codecs.open(gist_file, 'w', encoding='utf-8') as f:
-                json_dump(get_repo_raw_data(self.repo), f)
-        else:
-            if self.args.include_releases:
+            STORE.put(gist_file, get_repo_raw_data(self.repo))
+            return
+
+        empty = self._known_missing('empty')
+        if empty:
+            LOGGER.info("    Repo is empty, skipping releases and pull requests")
+
+        if self.args.include_releases and not empty:
+            with METRICS.phase('releases', self.name):
                 self._backup_releases()
 
-            if self.args.include_issues:
-                LOGGER.info("    Getting issues for repo %s", self.repo.name)
-                #self._backup_issues(self.repo.get_issues(state='all'), self.args, os.path.dirname(self.dir))
-                self._backup_issues(get_repo_issues(self.repo, 'all'), self.args, os.path.dirname(self.dir))
+        if self.args.include_issues:
+            with METRICS.phase('issues', self.name):
+                self._backup_repo_issues()
 
-            if self.args.include_pulls:
+        if self.args.include_pulls and not empty:
+            with METRICS.phase('pulls', self.name):
                 LOGGER.info("    Getting pull requests for repo %s", self.repo.name)
-                #self._backup_pulls(self.repo.get_pulls(state='all'), self.args, os.path.dirname(self.dir))
-                self._backup_pulls(get_repo_pulls(self.repo, 'all'), self.args, os.path.dirname(self.dir))
+                since = self._get_sync_mark('pulls')
+                if GRAPHQL:
+                    mark = self._backup_graphql('pull-requests', GRAPHQL.get_pulls(self.repo, self.args, since))
+                else:
+                    pulls = get_repo_pulls(self.repo, 'all', since)
+                    bulk = self._fetch_bulk_pull_data(since) if self.args.bulk_comments else None
+                    mark = self._backup_pulls(pulls, self.args, os.path.dirname(self.dir), since, bulk)
+                self._set_sync_mark('pulls', mark)
+
+    def _backup_repo_issues(self):
+        if not self.repo.has_issues:
+            LOGGER.info("    Issues are disabled for repo %s", self.repo.name)
+            return
+        if self._known_missing('issues'):
+            LOGGER.info("    Issues were disabled for repo %s at the last check", self.repo.name)
+            return
+        LOGGER.info("    Getting issues for repo %s", self.repo.name)
+        since = self._get_sync_mark('issues')
+        try:
+            if GRAPHQL:
+                mark = self._backup_graphql('issues', GRAPHQL.get_issues(self.repo, self.args, since))
+            else:
+                issues = get_repo_issues(self.repo, 'all', since)
+                bulk = self._fetch_bulk_issue_data(since) if self.args.bulk_comments else None
+                mark = self._backup_issues(issues, self.args, os.path.dirname(self.dir), since, bulk)
+        except github.GithubException as exc:
+            # 410 Gone: the listing still says has_issues, but they are disabled
+            if exc.status != 410:
+                raise
+            LOGGER.info("    Issues are disabled for repo %s", self.repo.name)
+            self._set_missing('issues', True)
+            return
+        self._set_missing('issues', False)
+        self._set_sync_mark('issues', mark)
+
+    def _backup_wiki(self):
+        config = os.path.join(self.wiki_dir, "config" if self.args.mirror else ".git/config")
+        if not os.access(os.path.dirname(self.wiki_dir), os.F_OK):
+            mkdir_p(os.path.dirname(self.wiki_dir))
+        if not os.access(config, os.F_OK):
+            if self._known_missing('wiki'):
+                LOGGER.info("Wiki repo didn't exist at the last check, skipping it")
+                return
+            LOGGER.info("Wiki repo doesn't exist, lets clone it")
+            errors = []
+            if self.clone_repo(self.wiki_url, self.wiki_dir, errors=errors):
+                shutil.rmtree(self.wiki_dir, ignore_errors=True)
+                # GitHub only creates the wiki repository with the first page.
+                # Other failures, such as network errors, are tried again next time
+                if GIT_NOT_FOUND.search(''.join(errors)):
+                    self._set_missing('wiki', True)
+            else:
+                self._set_missing('wiki', False)
+        else:
+            LOGGER.info("Wiki repo already exists, let's try to update it instead")
+            self.update_repo(self.wiki_dir)
 
-    def clone_repo(self, url, dir):
+    def plan(self):
+        """Estimate what backup() would do, with at most a few listing requests.
+
+        Request counts are lower bounds: comments and events are counted as
+        one request per issue, whatever their number.
+        """
+        raw = self.repo._rawData
+        config = os.path.join(self.dir, "config" if self.args.mirror else ".git/config")
+        item = {'name': str(self.name)}
+        requests = {'rest': 0, 'graphql': 0}
+        if not os.access(config, os.F_OK):
+            item['action'] = 'clone'
+            # The API reports repository sizes in KiB
+            item['clone_bytes'] = (raw.get('size') or 0) * 1024
+        elif not self.args.full_resync and 'refs' in self.state \
+                and self._get_pushed_at() == self.state.get('pushed_at'):
+            item['action'] = 'unchanged'
+        else:
+            item['action'] = 'fetch'
+
+        if self.is_gist:
+            item['requests'] = requests
+            return item
+
+        if self.args.include_releases and not self._known_missing('empty'):
+            releases, assets, asset_bytes = 0, 0, 0
+            known = self.state.get('assets', {})
+            url = '%s/releases?per_page=100' % self.repo.url
+            responses = []
+            while url:
+                resp = conditional_get(url, owner=self.repo)
+                if resp.status_code != 304:
+                    resp.raise_for_status()
+                responses.append(resp)
+                url = HTTP_CACHE.next_url(url, resp)
+            requests['rest'] += len(responses)
+            if any(resp.status_code != 304 for resp in responses):
+                # The validators are only stored by a real backup, so these
+                # stay changed until then
+                responses = [conditional_get(resp.url, False, self.repo) if resp.status_code == 304 else resp
+                             for resp in responses]
+            else:
+                responses = []
+            for resp in responses:
+                for release in resp.json():
+                    releases += 1
+                    for asset in release.get('assets', []) if self.args.include_assets else []:
+                        key = os.path.join(release['tag_name'], asset['name'])
+                        if known.get(key) != asset.get('updated_at'):
+                            assets += 1
+                            asset_bytes += asset.get('size', 0)
+            item.update({'releases': releases, 'assets': assets, 'asset_bytes': asset_bytes})
+            # Listing the releases and the assets of each
+            requests['rest'] += (1 + releases) if releases else 0
+            if releases and item['action'] == 'unchanged':
+                item['action'] = 'metadata'
+
+        issues_since = self._get_sync_mark('issues')
+        pulls_since = self._get_sync_mark('pulls')
+        if self.args.include_issues or self.args.include_pulls:
+            # The issues endpoint lists pull requests too
+            url = '%s/issues?state=all' % self.repo.url
+            since = issues_since if self.args.include_issues else pulls_since
+            if since:
+                # since is inclusive, and the issue the mark was taken from
+                # hasn't necessarily changed again
+                url += '&since=' + (since + timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            changed = count_listing(self.repo, url)
+            pulls = count_listing(self.repo, '%s/pulls?state=all' % self.repo.url) if not since else None
+            requests['rest'] += 1 if since else 2
+            if pulls is None:
+                # Without a sync mark to go by, guess the same share of pull requests
+                pulls = changed // 2 if self.args.include_pulls else 0
+            issues = max(changed - pulls, 0)
+            item.update({'issues': issues if self.args.include_issues else 0,
+                         'pulls': pulls if self.args.include_pulls else 0})
+            if changed and item['action'] == 'unchanged':
+                item['action'] = 'metadata'
+
+            if self.args.include_issues:
+                if self.args.graphql and IS_AUTHORIZED:
+                    requests['graphql'] += int(math.ceil(changed / float(self.args.graphql_page_size))) or 1
+                else:
+                    requests['rest'] += int(math.ceil(changed / 100.0)) or 1
+                    per_issue = int(self.args.include_issue_comments) + int(self.args.include_issue_events)
+                    if self.args.bulk_comments:
+                        requests['rest'] += per_issue * (int(math.ceil(changed / 100.0)) or 1)
+                    else:
+                        requests['rest'] += per_issue * issues
+            if self.args.include_pulls:
+                if self.args.graphql and IS_AUTHORIZED:
+                    requests['graphql'] += int(math.ceil(pulls / float(self.args.graphql_page_size))) or 1
+                else:
+                    requests['rest'] += int(math.ceil(pulls / 100.0)) or 1
+                    per_pull = int(self.args.include_pull_comments) + int(self.args.include_pull_commits)
+                    if self.args.bulk_comments:
+                        requests['rest'] += pulls * int(self.args.include_pull_commits) \
+                            + int(self.args.include_pull_comments) * (int(math.ceil(pulls / 100.0)) or 1)
+                    else:
+                        requests['rest'] += pulls * per_pull
+
+        item['requests'] = requests
+        return item
+
+    def _get_pushed_at(self):
+        # Gists have no pushed_at, but any change to them bumps updated_at
+        return self.repo._rawData.get('updated_at' if self.is_gist else 'pushed_at')
+
+    def _is_unchanged(self):
+        """Check whether the repository has seen no push since the last backup."""
+        if self.args.full_resync or 'refs' not in self.state:
+            return False
+        pushed_at = self._get_pushed_at()
+        if pushed_at and pushed_at != self.state.get('pushed_at'):
+            return False
+        refs = refs_fingerprint(self.dir, self.args.mirror)
+        if pushed_at and refs == self.state['refs']:
+            return True
+        # No push date to go by or the local refs have changed since the
+        # last backup, so let the remote refs decide
+        LOGGER.info("Comparing local refs with %s", self.url)
+        return refs is not None and refs == remote_refs_fingerprint(self.url)
+
+    def _save_push_state(self):
+        self.state['pushed_at'] = self._get_pushed_at()
+        self.state['updated_at'] = self.repo._rawData.get('updated_at')
+        self.state['refs'] = refs_fingerprint(self.dir, self.args.mirror)
+        save_state(self.state_file, self.state)
+
+    def _backup_graphql(self, kind, issues):
+        """Save issues or pull requests normalized by GraphQLClient and return the latest updated_at seen."""
+        mark = None
+        for issue_data in issues:
+            LOGGER.info("     * %s[%s]: %s", self.repo.name, issue_data['number'], issue_data['title'])
+            issue_file = os.path.join(os.path.dirname(self.dir), kind,
+                                      "{0}:{1}.json".format(self.repo.name, issue_data['number']))
+            STORE.put(issue_file, issue_data)
+            mark = max(mark or '', issue_data['updated_at']) or None
+        return mark
+
+    def _fetch_bulk_issue_data(self, since):
+        """Fetch the comments and events of all issues with repository-wide listings."""
+        bulk = {'comments': {}, 'events': {}}
+        if self.args.include_issue_comments:
+            LOGGER.info("    Getting issue comments for repo %s", self.repo.name)
+            for comment in get_repo_issues_comments(self.repo, since):
+                data = get_listed_raw_data(comment)
+                number = int(data['issue_url'].rsplit('/', 1)[1])
+                bulk['comments'].setdefault(number, []).append(data)
+        if self.args.include_issue_events:
+            LOGGER.info("    Getting issue events for repo %s", self.repo.name)
+            for event in get_repo_issues_events(self.repo):
+                data = get_listed_raw_data(event)
+                # The listing has no since parameter, but it is newest first
+                if since and parse_timestamp(data['created_at']) < since:
+                    break
+                if data.get('issue'):
+                    bulk['events'].setdefault(data['issue']['number'], []).append(data)
+        return bulk
+
+    def _fetch_bulk_pull_data(self, since):
+        """Fetch the review comments of all pull requests with one repository-wide listing."""
+        bulk = {'comments': {}}
+        if self.args.include_pull_comments:
+            LOGGER.info("    Getting pull request comments for repo %s", self.repo.name)
+            for comment in get_repo_pulls_comments(self.repo, since):
+                data = get_listed_raw_data(comment)
+                number = int(data['pull_request_url'].rsplit('/', 1)[1])
+                bulk['comments'].setdefault(number, []).append(data)
+        return bulk
+
+    def _get_sync_mark(self, kind):
+        """Return the datetime up to which `kind` has been synced, or None for a full sync.
+
+        The mark only holds for the options it was saved with: an issue that
+        didn't change since then has nothing of what they newly ask for.
+        """
+        mark = self.state.get('sync', {}).get(kind)
+        if self.args.full_resync or not mark:
+            return None
+        if self.state.get('sync_options', {}).get(kind) != self._sync_options(kind):
+            LOGGER.info("    The options for %s changed since the last backup, syncing them all", kind)
+            return None
+        return parse_timestamp(mark)
+
+    def _set_sync_mark(self, kind, mark):
+        if not mark:
+            return
+        self.state.setdefault('sync', {})[kind] = mark
+        self.state.setdefault('sync_options', {})[kind] = self._sync_options(kind)
+        save_state(self.state_file, self.state)
+
+    def _sync_options(self, kind):
+        options = dict((name, bool(getattr(self.args, name))) for name in SYNC_OPTIONS[kind])
+        options.update(metadata_store=self.args.metadata_store, graphql=GRAPHQL is not None)
+        return options
+
+    def _known_missing(self, kind):
+        """Check whether an earlier backup found no `kind` here, recently enough to still trust.
+
+        The result is trusted for --negative-cache-ttl hours, and only while
+        the repository metadata it depends on (see MISSING_KEYS) stays the same.
+        """
+        entry = self.state.get('missing', {}).get(kind)
+        if self.args.full_resync or not self.args.negative_cache_ttl or not entry:
+            return False
+        if entry['key'] != self.repo._rawData.get(MISSING_KEYS[kind]):
+            return False
+        return time.time() - entry['checked'] < self.args.negative_cache_ttl * 3600
+
+    def _set_missing(self, kind, missing):
+        missing_state = self.state.setdefault('missing', {})
+        if missing:
+            missing_state[kind] = {'key': self.repo._rawData.get(MISSING_KEYS[kind]), 'checked': time.time()}
+        elif missing_state.pop(kind, None) is None:
+            return
+        save_state(self.state_file, self.state)
+
+    def _maintain(self):
+        """Repack the repository and write its commit-graph once it has too many packs or loose objects."""
+        stats = count_objects(self.dir)
+        if stats is None:
+            return
+        tasks = []
+        if stats['packs'] > self.args.maintenance_max_packs or stats['count'] > self.args.maintenance_max_loose:
+            tasks.append(("repack", ["-d", "-q", "--geometric=2", "--write-midx"]))
+            tasks.append(("commit-graph", ["write", "--reachable", "--split"]))
+            if stats['count'] > self.args.maintenance_max_loose:
+                tasks.append(("prune", ["--expire=2.weeks.ago"]))
+        elif not os.path.exists(os.path.join(self.dir, "objects" if self.args.mirror else ".git/objects",
+                                             "info", "commit-graphs")):
+            tasks.append(("commit-graph", ["write", "--reachable", "--split"]))
+
+        for gcmd, gargs in tasks:
+            if not MAINTENANCE_BUDGET.run(gcmd, gargs, self.dir):
+                LOGGER.info("Maintenance budget used up, not maintaining %s", self.name)
+                break
+        if tasks:
+            stats = count_objects(self.dir) or stats
+        self.state['maintenance'] = stats
+
+    def _fetch_into_network(self):
+        """Fetch this fork's branches and tags into the object store shared by its fork network.
+
+        The store keeps them as refs/forks/<full name>/*, so it never loses
+        objects a fork still needs when it is repacked. Returns the store.
+        """
+        if 'network' not in self.state:
+            self.state['network'] = get_repo_source_name(self.repo)
+        store = os.path.join(self.args.backupdir, 'networks', self.state['network'] + '.git')
+        prefix = 'refs/forks/%s/' % self.repo.full_name
+        with network_lock(store):
+            if not os.access(os.path.join(store, 'config'), os.F_OK):
+                mkdir_p(store)
+                git("init", ["--bare", "--quiet"], gdir=store)
+            with NETWORKS_LOCK:
+                configured = store in NETWORKS
+            if not configured:
+                # A fetch may run gc --auto, which prunes objects no ref of the
+                # store points at but that a fork whose own fetch failed still
+                # needs. Only repack_network may drop objects.
+                git("config", ["--local", "gc.auto", "0"], gdir=store)
+                git("config", ["--local", "gc.pruneExpire", "never"], gdir=store)
+            LOGGER.info("Fetching into the fork network store %s", store)
+            if git("fetch", ["--prune", "--no-tags", self.url,
+                             "+refs/heads/*:%sheads/*" % prefix, "+refs/tags/*:%stags/*" % prefix],
+                   self.args.git, store):
+                raise GitError("git fetch of %s into %s failed" % (self.url, store))
+            forks_file = os.path.join(store, 'forks.json')
+            forks = load_state(forks_file)
+            forks[self.repo.full_name] = os.path.abspath(self.dir)
+            write_json(forks_file, forks)
+        with NETWORKS_LOCK:
+            NETWORKS.add(store)
+        return store
+
+    def _use_alternates(self, store):
+        """Borrow objects from store, dropping the local copies of the ones it has."""
+        objects = os.path.join(self.dir, "objects" if self.args.mirror else ".git/objects")
+        alternates = os.path.join(objects, 'info', 'alternates')
+        if os.access(alternates, os.F_OK):
+            return
+        LOGGER.info("Moving the objects of %s to the fork network store", self.repo.full_name)
+        mkdir_p(os.path.dirname(alternates))
+        with open(alternates, 'w') as f:
+            f.write(os.path.join(os.path.abspath(store), 'objects') + '\n')
+        git("repack", ["-a", "-d", "-l", "-q"], gdir=self.dir)
+
+    def clone_repo(self, url, dir, reference=None, errors=None):
         git_args = [url, os.path.basename(dir)]
         if self.args.mirror:
             git_args.insert(0, '--mirror')
+        if reference:
+            git_args[:0] = ['--reference', os.path.abspath(reference)]
 
-        git("clone", git_args, self.args.git, os.path.dirname(dir))
+        return git("clone", git_args, self.args.git, os.path.dirname(dir), cleanup=dir, errors=errors)
 
-    def update_repo(self, dir):
+    def update_repo(self, dir, fetch=True):
         # GitHub => Local
-        # TODO: use subprocess package and fork git into
-        #       background (major performance boost expected)
         args, repo = self.args, self.repo
-        if args.mirror:
-            git("fetch", ["--prune"], args.git, dir)
-        else:
-            git("pull", gargs=args.git, gdir=dir)
+        status = 0
+        if fetch and args.mirror:
+            status = git("fetch", ["--prune"], args.git, dir)
+        elif fetch:
+            status = git("pull", gargs=args.git, gdir=dir)
 
         # Fetch description and owner (useful for gitweb, cgit etc.)
+        config = {}
         if repo.description:
-            git("config", ["--local", "gitweb.description",
-                repo.description.encode("utf-8")], gdir=dir)
+            config["gitweb.description"] = repo.description
 
-        if repo.owner.name and repo.owner.email:
-            owner = "%s <%s>" % (repo.owner.name.encode("utf-8"),
-                                 repo.owner.email.encode("utf-8"))
-            git("config", ["--local", "gitweb.owner", owner], gdir=dir)
+        owner = get_owner_contact(repo.owner)
+        if owner:
+            config["gitweb.owner"] = owner
 
         if self.is_gist:
-            git("config", ["--local", "cgit.name", str(repo.id)], gdir=dir)
-            git("config", ["--local", "cgit.clone-url", str(repo.git_pull_url)], gdir=dir)
+            config["cgit.name"] = str(repo.id)
+            config["cgit.clone-url"] = str(repo.git_pull_url)
         else:
-            git("config", ["--local", "cgit.name", str(repo.name)], gdir=dir)
-            git("config", ["--local", "cgit.defbranch", str(repo.default_branch)], gdir=dir)
-            git("config", ["--local", "cgit.clone-url", str(repo.clone_url)], gdir=dir)
+            config["cgit.name"] = str(repo.name)
+            config["cgit.defbranch"] = str(repo.default_branch)
+            config["cgit.clone-url"] = str(repo.clone_url)
+
+        update_git_config(dir, config)
+
+        return status
 
     @classmethod
-    def _backup_issues(cls, issues, args, dir):
+    def _backup_issues(cls, issues, args, dir, since=None, bulk=None):
+        """Save issues into dir/issues and return the latest updated_at seen.
+
+        With `since`, only comments (and, from `bulk`, events) newer than it are
+        fetched and they are merged into the already saved issue files. `bulk` holds comments and events
+        already fetched per issue number by _fetch_bulk_issue_data.
+        """
+        mark = None
         for issue in issues:
             project = os.path.basename(os.path.dirname(os.path.dirname(issue.url)))
             issue_data = get_issue_raw_data(issue).copy()
             LOGGER.info("     * %s[%s]: %s", project, issue.number, issue.title)
+            issue_file = os.path.join(dir, 'issues', "{0}:{1}.json".format(project, issue.number))
+            old_data = STORE.get(issue_file) if since else {}
             if args.include_issue_comments and issue.comments:
-                #for comment in issue.get_comments():
-                for comment in get_issue_comments(issue):
-                    issue_data.setdefault('comment_data', []).append(get_comment_raw_data(comment))
+                issue_data['comment_data'] = old_data.get('comment_data', [])
+                if bulk is not None:
+                    comments = bulk['comments'].get(issue.number, [])
+                else:
+                    comments = [get_comment_raw_data(c) for c in get_issue_comments(issue, since)]
+                issue_data['comment_data'] = merge_by_id(issue_data['comment_data'], comments)
             if args.include_issue_events:
-                for event in get_issue_events(issue):
-                    issue_data.setdefault('event_data', []).append(get_event_raw_data(event))
-
-            issue_file = os.path.join(dir, 'issues', "{0}:{1}.json".format(project, issue.number))
-            if not os.access(os.path.dirname(issue_file), os.F_OK):
-                mkdir_p(os.path.dirname(issue_file))
-            with codecs.open(issue_file, 'w', encoding='utf-8') as f:
-                json_dump(issue_data, f)
+                if bulk is not None:
+                    events = bulk['events'].get(issue.number, [])
+                    if events or old_data.get('event_data'):
+                        issue_data['event_data'] = merge_by_id(old_data.get('event_data', []), events)
+                else:
+                    for event in get_issue_events(issue):
+                        issue_data.setdefault('event_data', []).append(get_event_raw_data(event))
+
+            STORE.put(issue_file, issue_data)
+            mark = max(mark or '', issue_data.get('updated_at') or '') or None
+        return mark
 
     @classmethod
-    def _backup_pulls(cls, issues, args, dir):
+    def _backup_pulls(cls, issues, args, dir, since=None, bulk=None):
+        """Save pull requests into dir/pull-requests and return the latest updated_at seen.
+
+        `since` and `bulk` work as in _backup_issues.
+        """
+        mark = None
         for issue in issues:
             project = os.path.basename(os.path.dirname(os.path.dirname(issue.url)))
             if isinstance(issue, github.Issue.Issue):
                 issue = get_issue_as_pull_request(issue)
             issue_data = get_issue_raw_data(issue).copy()
             LOGGER.info("     * %s[%s]: %s", project, issue.number, issue.title)
+            issue_file = os.path.join(dir, 'pull-requests', "{0}:{1}.json".format(project, issue.number))
+            old_data = STORE.get(issue_file) if since else {}
             if args.include_pull_comments and issue.comments:
-                for comment in get_issue_comments(issue):
-                    issue_data.setdefault('comment_data', []).append(get_comment_raw_data(comment))
+                issue_data['comment_data'] = old_data.get('comment_data', [])
+                if bulk is not None:
+                    comments = bulk['comments'].get(issue.number, [])
+                else:
+                    comments = [get_comment_raw_data(c) for c in get_issue_comments(issue, since)]
+                issue_data['comment_data'] = merge_by_id(issue_data['comment_data'], comments)
             if args.include_pull_commits and issue.commits:
                 for commit in get_issue_commits(issue):
                     issue_data.setdefault('commit_data', []).append(get_commit_raw_data(commit))
 
-            issue_file = os.path.join(dir, 'pull-requests', "{0}:{1}.json".format(project, issue.number))
-            if not os.access(os.path.dirname(issue_file), os.F_OK):
-                mkdir_p(os.path.dirname(issue_file))
-            with codecs.open(issue_file, 'w', encoding='utf-8') as f:
-                json_dump(issue_data, f)
+            STORE.put(issue_file, issue_data)
+            mark = max(mark or '', issue_data.get('updated_at') or '') or None
+        return mark
 
     def _backup_releases(self):
+        # Ask for the release list with the validators of the last backup
+        # first, and skip the releases altogether if none of its pages changed
+        responses = []
+        url = '%s/releases?per_page=100' % self.repo.url
+        while url:
+            resp = conditional_get(url, owner=self.repo)
+            if resp.status_code != 304:
+                resp.raise_for_status()
+            responses.append((url, resp))
+            url = HTTP_CACHE.next_url(url, resp)
+        rel_dir = os.path.join(os.path.dirname(self.dir), 'releases')
+        # The validators only vouch for the listing, not for what the last
+        # backup saved of it with its options, or for the files still there
+        options = {'assets': bool(self.args.include_assets), 'metadata_store': self.args.metadata_store,
+                   'dedupe_assets': bool(self.args.dedupe_assets)}
+        saved = self.state.get('releases') == options and (not self.args.include_assets or all(
+            os.path.exists(os.path.join(rel_dir, key)) for key in self.state.get('assets', {})))
+        if all(resp.status_code == 304 for _, resp in responses) and saved:
+            LOGGER.info("    Releases unchanged since the last backup")
+            return
+
         for release in get_repo_releases(self.repo):
-            rel_dir = os.path.join(os.path.dirname(self.dir), 'releases')
             rel_file = os.path.join(rel_dir, release.tag_name+'.json')
-            if not os.access(rel_dir, os.F_OK):
-                mkdir_p(rel_dir)
-            with codecs.open(rel_file, 'w', encoding='utf-8') as f:
-                json_dump(get_release_raw_data(release), f)
+            STORE.put(rel_file, get_release_raw_data(release))
 
             if self.args.include_assets:
-                for asset in get_release_assets(release):
-                    asset_dir = os.path.join(rel_dir, release.tag_name)
-                    asset_file = os.path.join(asset_dir, asset.name)
-                    if not os.access(asset_dir, os.F_OK):
-                        mkdir_p(asset_dir)
-                    fetch_url(asset.browser_download_url, asset_file)
-                    assert asset.size == os.path.getsize(asset_file)
+                with METRICS.phase('assets', self.name):
+                    self._backup_assets(release, os.path.join(rel_dir, release.tag_name))
+
+        self.state['releases'] = options
+        save_state(self.state_file, self.state)
+        for url, resp in responses:
+            HTTP_CACHE.store(url, resp)
+
+    def _backup_assets(self, release, asset_dir):
+        """Download the assets of a release that changed since the last backup, several at a time."""
+        known = self.state.setdefault('assets', {})
+        downloads = []
+        linked = False
+        for asset in get_release_assets(release):
+            asset_file = os.path.join(asset_dir, asset.name)
+            key = os.path.join(release.tag_name, asset.name)
+            updated_at = asset._rawData.get('updated_at')
+            if known.get(key) == updated_at and os.path.exists(asset_file) \
+               and os.path.getsize(asset_file) == asset.size:
+                LOGGER.debug("Asset %s is up to date", key)
+                # Assets downloaded before --dedupe-assets was turned on
+                if ASSET_STORE and not ASSET_STORE.lookup(asset._rawData):
+                    ASSET_STORE.add(asset._rawData, asset_file)
+                continue
+            blob = ASSET_STORE.lookup(asset._rawData) if ASSET_STORE else None
+            if blob:
+                LOGGER.info("     * Linking stored asset %s", key)
+                mkdir_p(asset_dir)
+                link_file(blob, asset_file)
+                known[key] = updated_at
+                linked = True
+                continue
+            downloads.append((key, updated_at, asset._rawData, asset_file))
+
+        if not downloads:
+            if linked:
+                save_state(self.state_file, self.state)
+            return
+        if not os.access(asset_dir, os.F_OK):
+            mkdir_p(asset_dir)
+
+        def download(download):
+            key, updated_at, asset_data, asset_file = download
+            LOGGER.info("     * Downloading asset %s", key)
+            fetch_url(asset_data['browser_download_url'], asset_file, asset_data['size'])
+            if ASSET_STORE:
+                ASSET_STORE.add(asset_data, asset_file)
+            return key, updated_at
+
+        with ThreadPoolExecutor(max_workers=self.args.asset_jobs) as executor:
+            for key, updated_at in executor.map(download, downloads):
+                known[key] = updated_at
+        save_state(self.state_file, self.state)
+
+
+def git(gcmd, args=[], gargs=[], gdir="", cleanup=None, errors=None):
+    """Run a git command and return its exit status.
+
+    Network commands are run under WATCHDOG and retried if they time out;
+    cleanup is a directory to remove before retrying, such as the target of
+    a clone. Their messages are appended to the list errors, if given.
+    """
+    cmd = ["git"]
+    if gdir:
+        cmd.extend(["-C", gdir])
+    if gcmd in GIT_NETWORK_COMMANDS:
+        cmd.extend(WATCHDOG.git_config())
+    cmd.append(gcmd)
+    if gcmd in ('clone', 'fetch', 'pull'):
+        # For run_watched to measure the transfer by
+        cmd.append('--progress')
+    cmd.extend(gargs)
+    cmd.extend(args)
 
+    LOGGER.info("Running %s", ' '.join(cmd))
+    if gcmd not in GIT_NETWORK_COMMANDS:
+        start = time.time()
+        try:
+            return subprocess.call(cmd)
+        finally:
+            METRICS.observe(METRICS.git, gcmd, time.time() - start)
+
+    what = 'git %s in %s' % (' '.join([gcmd] + args), gdir or os.getcwd())
+    for attempt in range(WATCHDOG.retries + 1):
+        start = time.time()
+        try:
+            with GIT_SLOTS:
+                returncode, output = run_watched(cmd, what)
+            if errors is not None:
+                errors.append(output)
+            return returncode
+        except Stalled:
+            if attempt == WATCHDOG.retries:
+                raise
+        finally:
+            METRICS.observe(METRICS.git, gcmd, time.time() - start)
+        if cleanup:
+            shutil.rmtree(cleanup, ignore_errors=True)
+        WATCHDOG.pause(attempt)
+
+def run_watched(cmd, what):
+    """Run a network git command, killing it if it runs over WATCHDOG.git_timeout or stalls.
+
+    Returns its exit status and messages.
+    """
+    # In its own process group, so that its helpers (git-remote-https,
+    # index-pack, ssh) are killed with it
+    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, start_new_session=True)
+
+    def kill():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
 
-def git(gcmd, args=[], gargs=[], gdir=""):
+    try:
+        with WATCHDOG.watch('git', what, kill, WATCHDOG.git_timeout, measure=True) as progress:
+            err = read_git_progress(proc.stderr, progress)
+            proc.wait()
+    except BaseException:
+        kill()
+        proc.wait()
+        raise
+    match = proc.returncode and GIT_STALL_MESSAGE.search(err)
+    if match:
+        raise WATCHDOG.stalled('git', what, match.group(0).lower())
+    return proc.returncode, err
+
+def read_git_progress(stream, progress):
+    """Pass on what git writes to stream, except its progress meters, and return it.
+
+    The meters are reported to progress: the bytes received as they grow,
+    and the other stages as None.
+    """
+    output = []
+    received = 0
+    pending = b''
+    while True:
+        data = stream.read1(4096)
+        if not data:
+            break
+        # Meters are redrawn with \r, other messages end with \n
+        lines = re.split(br'[\r\n]', pending + data)
+        pending = lines.pop()
+        for line in lines:
+            line = line.decode('utf-8', 'replace')
+            match = GIT_RECEIVED.match(line)
+            if match:
+                total = int(float(match.group(1)) * GIT_UNITS[match.group(2)])
+                progress(max(total - received, 0))
+                received = total
+            elif GIT_PROGRESS.match(line):
+                progress(None)
+            elif line:
+                sys.stderr.write(line + '\n')
+                output.append(line)
+    if pending:
+        sys.stderr.write(pending.decode('utf-8', 'replace') + '\n')
+        output.append(pending.decode('utf-8', 'replace'))
+    return '\n'.join(output)
+
+def git_output(gcmd, args=[], gdir=""):
+    """Run a git command and return its output, or None if it failed."""
     cmd = ["git"]
     if gdir:
         cmd.extend(["-C", gdir])
     cmd.append(gcmd)
-    cmd.extend(gargs)
     cmd.extend(args)
 
-    print(cmd)
-    subprocess.call(cmd)
+    try:
+        if gcmd not in GIT_NETWORK_COMMANDS:
+            return subprocess.check_output(cmd).decode('utf-8')
+        with GIT_SLOTS:
+            return subprocess.check_output(cmd, timeout=WATCHDOG.git_timeout or None).decode('utf-8')
+    except subprocess.TimeoutExpired:
+        WATCHDOG.stalled('git', 'git %s in %s' % (gcmd, gdir or os.getcwd()),
+                         'ran for more than %d seconds' % WATCHDOG.git_timeout)
+        return None
+    except subprocess.CalledProcessError:
+        return None
+
+def update_git_config(gdir, config):
+    """Set the local config values in config that differ from what gdir has."""
+    output = git_output("config", ["--local", "-z", "--get-regexp", r"^(gitweb|cgit)\."], gdir) or ''
+    current = dict((entry.split('\n', 1) + [''])[:2] for entry in output.split('\0') if entry)
+    for key, value in sorted(config.items()):
+        if current.get(key) != value:
+            git("config", ["--local", key, value], gdir=gdir)
+
+class MaintenanceBudget(object):
+    """The time left for repository maintenance in this run."""
+
+    def __init__(self, seconds):
+        self.lock = threading.Lock()
+        self.remaining = seconds
+
+    def run(self, gcmd, gargs, gdir):
+        """Run a maintenance git command if there is time left, and return whether it completed.
+
+        The command is stopped when it runs past the time that was left.
+        """
+        with self.lock:
+            remaining = self.remaining
+        if remaining <= 0:
+            return False
+        cmd = ["git", "-C", gdir, gcmd] + gargs
+        LOGGER.info("Running %s", ' '.join(cmd))
+        start = time.time()
+        # In its own process group, so that pack-objects is stopped with it
+        proc = subprocess.Popen(cmd, start_new_session=True)
+        try:
+            proc.wait(timeout=remaining)
+            completed = True
+        except subprocess.TimeoutExpired:
+            LOGGER.warning("git %s in %s ran past the maintenance budget, stopping it", gcmd, gdir)
+            # Unlike SIGKILL, SIGTERM lets git remove its lock and temporary files
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+            completed = False
+        except BaseException:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+            raise
+        finally:
+            METRICS.observe(METRICS.git, gcmd, time.time() - start)
+            with self.lock:
+                self.remaining -= time.time() - start
+        return completed
+
+MAINTENANCE_BUDGET = MaintenanceBudget(0)
+
+def count_objects(gdir):
+    """Return the loose object and pack counts and sizes (in KiB) of a repository."""
+    output = git_output("count-objects", ["-v"], gdir)
+    if output is None:
+        return None
+    stats = {}
+    for line in output.splitlines():
+        key, value = line.split(':', 1)
+        stats[key.strip().replace('-', '_')] = int(value.split()[0]) if value.strip() else 0
+    return {
+        'count': stats.get('count', 0),
+        'size': stats.get('size', 0),
+        'packs': stats.get('packs', 0),
+        'size_pack': stats.get('size_pack', 0),
+    }
+
+NETWORKS = set()
+NETWORKS_LOCK = threading.Lock()
+NETWORK_LOCKS = {}
+NETWORK_MAX_PACKS = 20
+
+def network_lock(store):
+    with NETWORKS_LOCK:
+        return NETWORK_LOCKS.setdefault(store, threading.Lock())
+
+def repack_network(store):
+    """Repack the object store of a fork network without losing objects its forks need.
+
+    The current refs of every fork that borrows from the store are fetched
+    into it first, so everything they reference stays reachable.
+    """
+    LOGGER.info("Repacking fork network store %s", store)
+    forks = load_state(os.path.join(store, 'forks.json'))
+    for name, dir in sorted(forks.items()):
+        if not os.path.isdir(dir):
+            continue
+        if git("fetch", ["--quiet", "--prune", "--no-tags", dir, "+refs/*:refs/forks/%s/local/*" % name], gdir=store):
+            LOGGER.warning("Could not read the refs of %s, not repacking %s", dir, store)
+            return
+    git("repack", ["-a", "-d", "-q"], gdir=store)
+
+def repack_networks():
+    for store in sorted(NETWORKS):
+        packs = glob.glob(os.path.join(store, 'objects', 'pack', '*.pack'))
+        if len(packs) > NETWORK_MAX_PACKS:
+            repack_network(store)
+
+OWNER_CONTACTS = {}
+OWNER_CONTACTS_LOCK = threading.Lock()
+
+def get_owner_contact(owner):
+    """Return "name <email>" for owner, looking each owner up only once."""
+    with OWNER_CONTACTS_LOCK:
+        if owner.login in OWNER_CONTACTS:
+            return OWNER_CONTACTS[owner.login]
+    name, email = get_owner_name_and_email(owner)
+    contact = "%s <%s>" % (name, email) if name and email else None
+    with OWNER_CONTACTS_LOCK:
+        OWNER_CONTACTS[owner.login] = contact
+    return contact
+
+@rate_limited_retry()
+def get_repo(gh, full_name):
+    return gh.get_repo(full_name)
+
+@rate_limited_retry()
+def get_repo_source_name(repo):
+    # Listed repositories don't include their parent or source
+    headers, data = repo.requester.requestJsonAndCheck("GET", repo.url)
+    return data.get('source', data)['full_name']
+
+@rate_limited_retry()
+def get_owner_name_and_email(owner):
+    return owner.name, owner.email
+
+def _fingerprint(refs):
+    return hashlib.sha1('\n'.join(sorted(refs)).encode('utf-8')).hexdigest()
+
+def refs_fingerprint(gdir, mirror):
+    """Hash the branches and tags of a local clone like remote_refs_fingerprint does."""
+    output = git_output("for-each-ref", ["--format=%(objectname) %(refname)"], gdir)
+    if output is None:
+        return None
+    refs = []
+    for line in output.splitlines():
+        sha, ref = line.split(' ', 1)
+        if not mirror:
+            # Only the remote tracking branches mirror the remote's branches
+            if ref.startswith('refs/heads/') or ref == 'refs/remotes/origin/HEAD':
+                continue
+            if ref.startswith('refs/remotes/origin/'):
+                ref = 'refs/heads/' + ref[len('refs/remotes/origin/'):]
+        if ref.startswith(('refs/heads/', 'refs/tags/')):
+            refs.append(sha + ' ' + ref)
+    return _fingerprint(refs)
+
+def remote_refs_fingerprint(url):
+    """Hash the branches and tags of a remote repository."""
+    output = git_output("ls-remote", ["--heads", "--tags", url])
+    if output is None:
+        return None
+    refs = []
+    for line in output.splitlines():
+        sha, ref = line.split('\t', 1)
+        if not ref.endswith('^{}'):
+            refs.append(sha + ' ' + ref)
+    return _fingerprint(refs)
+
+def json_dumps(data):
+    return json.dumps(data,
+                      ensure_ascii=False,
+                      sort_keys=True,
+                      indent=4,
+                      separators=(',', ': '))
 
 def json_dump(data, output_file):
     json.dump(data,
@@ -644,6 +3679,102 @@ def json_dump(data, output_file):
               indent=4,
               separators=(',', ': '))
 
+def load_state(path):
+    """Load a JSON file written by json_dump, or return {} if there is none."""
+    try:
+        with codecs.open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_state(path, state):
+    write_json(path, state)
+
+class JSONWriter(object):
+    """Write JSON files atomically, and only if their content changed.
+
+    Unchanged files keep their mtime, and a killed run never leaves a
+    half-written file behind.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+
+    def write(self, path, data):
+        with METRICS.phase('json-write'):
+            return self._write(path, data)
+
+    def _write(self, path, data):
+        content = json_dumps(data).encode('utf-8')
+        if self._unchanged(path, hashlib.sha256(content).digest(), len(content)):
+            return False
+        dir = os.path.dirname(path)
+        if not os.access(dir, os.F_OK):
+            mkdir_p(dir)
+        tmp_path = '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self._count(True)
+        return True
+
+    def replace(self, tmp_path, path):
+        """Move a completely written tmp_path to path, unless path already has the same content."""
+        digest, size = file_digest(tmp_path), os.path.getsize(tmp_path)
+        if self._unchanged(path, digest, size):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+        self._count(True)
+        return True
+
+    def _unchanged(self, path, digest, size):
+        try:
+            unchanged = os.path.getsize(path) == size and file_digest(path) == digest
+        except OSError:
+            return False
+        if unchanged:
+            self._count(False)
+        return unchanged
+
+    def _count(self, written):
+        with self.lock:
+            if written:
+                self.written += 1
+            else:
+                self.skipped += 1
+
+JSON_WRITER = JSONWriter()
+
+def write_json(path, data):
+    return JSON_WRITER.write(path, data)
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.digest()
+
+def merge_by_id(old, new):
+    """Merge two lists of API objects, preferring the entries in new."""
+    merged = dict((item['id'], item) for item in old)
+    merged.update((item['id'], item) for item in new)
+    return sorted(merged.values(), key=lambda item: item['id'])
+
+def parse_size(value):
+    """Parse a byte count with an optional K, M or G suffix."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_timestamp(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
 def mkdir_p(path):
     head, tail = os.path.split(path)
     if head and not os.access(head, os.F_OK):
@@ -658,4 +3789,4 @@ def mkdir_p(path):
             raise
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
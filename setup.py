@@ -10,8 +10,11 @@ setup(name='GitHub-Backup',
       packages=['github_backup'],
       install_requires=[
           'requests',
-          'PyGitHub'
+          'PyGithub>=2.1'
       ],
+      extras_require={
+          'jsonl': ['zstandard'],
+      },
       entry_points = {
         'console_scripts': [
             'github-backup=github_backup.github_backup:main'